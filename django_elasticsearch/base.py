@@ -1,8 +1,14 @@
+import threading
+import time
+from contextlib import contextmanager
+
 from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_finished
 
 from .creation import DatabaseCreation
 from .serializer import Decoder, Encoder
 from pyes import ES
+from pyes.utils import make_path
 
 from djangotoolbox.db.base import NonrelDatabaseFeatures, \
     NonrelDatabaseWrapper, NonrelDatabaseClient, \
@@ -10,20 +16,76 @@ from djangotoolbox.db.base import NonrelDatabaseFeatures, \
 
 from djangotoolbox.db.base import NonrelDatabaseOperations
 
+#indices known to exist, shared by all the connections of the process
+_known_indices = set()
+_known_indices_lock = threading.Lock()
+#nodes whose server version was checked
+_checked_servers = set()
+
+#supported elasticsearch versions, [first, last): 5.6 has the update and
+#delete by query syntax in use, 6.0 forbids several mapping types in the
+#database index
+SERVER_VERSIONS = ((5, 6), (6, 0))
+
+#ESMeta options copied in the settings of a per-model index
+INDEX_SETTINGS = ('number_of_shards', 'number_of_replicas', 'refresh_interval')
+
+REFRESH_ALWAYS = 'always'
+REFRESH_NEVER = 'never'
+REFRESH_REQUEST = 'request'
+
+def parse_refresh_policy(policy):
+    """
+    Validates a REFRESH option: 'always' (every write is searchable when it
+    returns), 'never' (leave it to the server refresh_interval), 'request'
+    (refresh once when the request is finished) or a number of milliseconds
+    (refresh with a write at most every N ms).
+    """
+    if policy in (REFRESH_ALWAYS, REFRESH_NEVER, REFRESH_REQUEST):
+        return policy
+    try:
+        return int(policy)
+    except (TypeError, ValueError):
+        raise ImproperlyConfigured("REFRESH must be 'always', 'never', "
+                                   "'request' or a number of milliseconds")
+
 class DatabaseOperations(NonrelDatabaseOperations):
     compiler_module = __name__.rsplit('.', 1)[0] + '.compiler'
 
     def sql_flush(self, style, tables, sequence_list):
+        """
+        Deletes the documents of tables with a delete-by-query on the index
+        of each model, the indices and the mappings are kept (a mapping
+        can't be deleted since elasticsearch 2.0).
+        """
+        from django.db.models import get_models
+        es = self.connection.db_connection
+        models = dict((model._meta.db_table, model) for model in get_models())
+        indices = {}
         for table in tables:
-            self.connection.db_connection.delete_mapping(self.connection.db_name, table)
+            if table in models:
+                index = self.connection.index_for_model(models[table])
+            else:
+                index = self.connection.db_name
+            indices.setdefault(index, []).append(table)
+        for index, doc_types in sorted(indices.items()):
+            path = make_path([index, ','.join(doc_types), '_delete_by_query'])
+            es._send_request('POST', path, {"query": {"match_all": {}}},
+                             {'conflicts': 'proceed', 'refresh': 'true',
+                              'ignore_unavailable': 'true'})
         return []
 
     def check_aggregate_support(self, aggregate):
         """
-        This function is meant to raise exception if backend does
-        not support aggregation.
+        Count, Sum, Avg, Min and Max are computed by elasticsearch metric
+        aggregations, any other aggregate raises NotImplementedError.
         """
-        pass
+        from .compiler import AGGREGATIONS
+        if aggregate.sql_function not in AGGREGATIONS:
+            raise NotImplementedError("%s is not supported by the elasticsearch backend"
+                                      % aggregate.sql_function)
+        if aggregate.extra.get('distinct'):
+            raise NotImplementedError("COUNT(DISTINCT) is not supported by the elasticsearch backend")
     
 class DatabaseFeatures(NonrelDatabaseFeatures):
     string_based_auto_field = True
@@ -37,10 +99,18 @@ class DatabaseValidation(NonrelDatabaseValidation):
 class DatabaseIntrospection(NonrelDatabaseIntrospection):
     def table_names(self):
         """
-        Show defined models
+        The doc types mapped in the database index and in the per-model
+        indices
         """
-        # TODO: get indices
-        return []
+        es = self.connection.db_connection
+        db_name = self.connection.db_name
+        path = make_path(['%s,%s_*' % (db_name, db_name), '_mapping'])
+        result = es._send_request('GET', path, params={'ignore_unavailable': 'true'})
+        tables = set()
+        for mappings in result.values():
+            tables.update(mappings.get('mappings', {}))
+        tables.discard('_default_')
+        return sorted(tables)
 
     def sequence_list(self):
         # TODO: check if it's necessary to implement that
@@ -61,6 +131,22 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
         self.introspection = DatabaseIntrospection(self)
         self._is_connected = False
 
+        options = self.settings_dict.get('OPTIONS', {})
+        #number of hits read per request when streaming a whole queryset
+        self.scroll_size = int(options.get('SCROLL_SIZE', 500))
+        #how long the server keeps a scroll context alive between chunks
+        self.scroll_timeout = options.get('SCROLL_TIMEOUT', '5m')
+        #limits of a single _bulk request
+        self.bulk_size = int(options.get('BULK_SIZE', 500))
+        self.bulk_max_bytes = int(options.get('BULK_MAX_BYTES', 5 * 1024 * 1024))
+        self.refresh_policy = parse_refresh_policy(options.get('REFRESH', REFRESH_ALWAYS))
+        #create the index on first use instead of waiting for syncdb
+        self.auto_create_index = bool(options.get('AUTO_CREATE_INDEX', False))
+        #settings of the database index, models with an ESMeta index have their own
+        self.index_settings = options.get('INDEX_SETTINGS', {})
+        self._dirty = False
+        self._last_refresh = time.time()
+
     @property
     def db_connection(self):
         self._ensure_is_connected()
@@ -68,24 +154,181 @@ class DatabaseWrapper(NonrelDatabaseWrapper):
 
     def _ensure_is_connected(self):
         if not self._is_connected:
-            try:
-                port = int(self.settings_dict['PORT'])
-            except ValueError:
-                raise ImproperlyConfigured("PORT must be an integer")
+            hosts = self.settings_dict.get('HOSTS') or \
+                ["%s:%s" % (self.settings_dict['HOST'], self.settings_dict['PORT'])]
+            nodes = []
+            for host in hosts:
+                name, _, port = host.rpartition(':')
+                try:
+                    nodes.append((name, int(port)))
+                except ValueError:
+                    raise ImproperlyConfigured("PORT must be an integer")
 
             self.db_name = self.settings_dict['NAME']
 
-            self._connection = ES("%s:%s" % (self.settings_dict['HOST'], port),
+            options = self.settings_dict.get('OPTIONS', {})
+            self._connection = ES(["%s:%s" % node for node in nodes],
                                   decoder=Decoder,
                                   encoder=Encoder,
-                                  autorefresh=True,
                                   default_indices=[self.db_name])
+            #keep-alive connections spread over all the nodes
+            from .connection import NodePool, ROUND_ROBIN
+            try:
+                self._connection.connection = NodePool(nodes,
+                    strategy=options.get('POOL_STRATEGY', ROUND_ROBIN),
+                    timeout=options.get('TIMEOUT'),
+                    maxsize=int(options.get('POOL_MAXSIZE', 10)),
+                    max_retries=int(options.get('MAX_RETRIES', 3)),
+                    retry_time=float(options.get('RETRY_TIME', 1)))
+            except ValueError, e:
+                raise ImproperlyConfigured(str(e))
 
             self._db_connection = self._connection
-            #auto index creation: check if to remove
-            try:
-                self._connection.create_index(self.db_name)
-            except:
-                pass
+            self._nodes = tuple(nodes)
             # We're done!
             self._is_connected = True
+            if self.auto_create_index:
+                self.ensure_index(settings=self.index_settings_for_model())
+
+    def check_server_version(self):
+        """
+        Raises ImproperlyConfigured if the cluster runs a version outside
+        SERVER_VERSIONS. The check is done once per process and nodes, when
+        an index is set up.
+        """
+        self._ensure_is_connected()
+        if self._nodes in _checked_servers:
+            return
+        number = self._connection._send_request('GET', '/')['version']['number']
+        version = tuple(int(part) for part in number.split('-')[0].split('.')[:2])
+        first, last = SERVER_VERSIONS
+        if not first <= version < last:
+            raise ImproperlyConfigured("Elasticsearch %s is not supported, the backend "
+                                       "needs %s.%s to %s.x" % (number, first[0], first[1], last[0] - 1))
+        _checked_servers.add(self._nodes)
+
+    def index_for_model(self, model):
+        """
+        The index (or alias) holding the documents of model: the database
+        index, or <database>_<index> for models with an ESMeta index.
+        """
+        self._ensure_is_connected()
+        index = getattr(model._meta, 'index', None)
+        if not index:
+            return self.db_name
+        return "%s_%s" % (self.db_name, index)
+
+    def index_settings_for_model(self, model=None):
+        """
+        The settings used to create the index of model (the database index
+        when model is None), with the analyzers the mappings refer to.
+        """
+        from .mapping import ANALYSIS_SETTINGS
+        if model is None or not getattr(model._meta, 'index', None):
+            settings = dict(self.index_settings)
+        else:
+            settings = dict(getattr(model._meta, 'index_settings', {}))
+            for name in INDEX_SETTINGS:
+                value = getattr(model._meta, name, None)
+                if value is not None:
+                    settings[name] = value
+        settings.setdefault('analysis', ANALYSIS_SETTINGS)
+        return settings
+
+    def ensure_index(self, index=None, settings=None):
+        """
+        Creates the index if it doesn't exist. The check is done once per
+        process and index.
+        """
+        self._ensure_is_connected()
+        index = index or self.db_name
+        key = (self._nodes, index)
+        if key in _known_indices:
+            return
+        with _known_indices_lock:
+            if key in _known_indices:
+                return
+            self.check_server_version()
+            if not self._connection.indices.exists_index(index):
+                self._connection.indices.create_index(index, settings and {'settings': settings})
+            _known_indices.add(key)
+
+    def ensure_model_index(self, model):
+        self.ensure_index(self.index_for_model(model), self.index_settings_for_model(model))
+
+    def forget_index(self, index=None):
+        """
+        Drops the cached existence of an index and of its per-model
+        indices, after they were deleted.
+        """
+        self._ensure_is_connected()
+        index = index or self.db_name
+        with _known_indices_lock:
+            for key in list(_known_indices):
+                if key[0] == self._nodes and \
+                        (key[1] == index or key[1].startswith(index + '_')):
+                    _known_indices.discard(key)
+
+    def write_params(self):
+        """
+        Querystring arguments for a single document write, according to
+        the current refresh policy.
+        """
+        if self._refresh_due():
+            return {'refresh': 'true'}
+        return {}
+
+    def bulk_written(self):
+        """
+        Applies the refresh policy once after a batch of writes.
+        """
+        if self._refresh_due():
+            self.refresh_index()
+
+    def refresh_if_dirty(self):
+        """
+        Refreshes the index if it was written since the last refresh.
+        """
+        if self._dirty:
+            self.refresh_index()
+
+    def refresh_index(self):
+        #the database index and the per-model ones
+        self.db_connection.refresh([self.db_name, self.db_name + '_*'])
+        self._dirty = False
+        self._last_refresh = time.time()
+
+    @contextmanager
+    def refresh_policy_override(self, policy):
+        """
+        Overrides the REFRESH policy for the writes made in the with block:
+
+            with connections['default'].refresh_policy_override('never'):
+                ...
+        """
+        previous = self.refresh_policy
+        self.refresh_policy = parse_refresh_policy(policy)
+        try:
+            yield self
+        finally:
+            self.refresh_policy = previous
+
+    def _refresh_due(self):
+        policy = self.refresh_policy
+        if policy == REFRESH_ALWAYS or (isinstance(policy, int) and
+                time.time() - self._last_refresh >= policy / 1000.0):
+            self._dirty = False
+            self._last_refresh = time.time()
+            return True
+        self._dirty = True
+        return False
+
+def _refresh_finished_request(**kwargs):
+    from django.db import connections
+    for alias in connections:
+        connection = connections[alias]
+        if isinstance(connection, DatabaseWrapper) and \
+                connection.refresh_policy == REFRESH_REQUEST:
+            connection.refresh_if_dirty()
+
+request_finished.connect(_refresh_finished_request)
@@ -1,8 +1,10 @@
 import sys
 import re
+import json
 
 from datetime import datetime
 from functools import wraps
+from itertools import islice
 
 from django.conf import settings
 from django.db import models
@@ -17,17 +19,34 @@ from django.db.models.fields import NOT_PROVIDED
 from django.utils.tree import Node
 from pyes import MatchAllQuery, FilteredQuery, BoolQuery, StringQuery, \
                 WildcardQuery, RegexTermQuery, RangeQuery, ESRange, \
-                TermQuery, ConstantScoreQuery, TermFilter, TermsFilter, NotFilter, RegexTermFilter
+                TermQuery, ConstantScoreQuery, TermFilter, TermsFilter, NotFilter, RegexTermFilter, \
+                PrefixFilter, RawFilter, RangeFilter, ExistsFilter, BoolFilter
+from pyes.filters import Filter
+from pyes.query import Query, Search
+from pyes.exceptions import ElasticSearchException, NotFoundException
+from pyes.utils import make_path
 from djangotoolbox.db.basecompiler import NonrelQuery, NonrelCompiler, \
     NonrelInsertCompiler, NonrelUpdateCompiler, NonrelDeleteCompiler
 from django.db.models.fields import AutoField
 import logging
+from .serializer import parse_datetime
+
+def _parse_date(val):
+    val = parse_datetime(val)
+    return val.date() if isinstance(val, datetime) else val
+
+def _parse_time(val):
+    val = parse_datetime(val)
+    return val.time() if isinstance(val, datetime) else val
 
 TYPE_MAPPING_FROM_DB = {
     'unicode':  lambda val: unicode(val),
     'int':      lambda val: int(val),
     'float':    lambda val: float(val),
     'bool':     lambda val: bool(val),
+    'datetime': parse_datetime,
+    'date':     _parse_date,
+    'time':     _parse_time,
 }
 
 TYPE_MAPPING_TO_DB = {
@@ -42,35 +61,164 @@ TYPE_MAPPING_TO_DB = {
 
 OPERATORS_MAP = {
     'exact':    lambda val: val,
-    'iexact':    lambda val: val, #tofix
-    'startswith':    lambda val: r'^%s' % re.escape(val),
-    'istartswith':    lambda val: r'^%s' % re.escape(val),
-    'endswith':    lambda val: r'%s$' % re.escape(val),
-    'iendswith':    lambda val: r'%s$' % re.escape(val),
-    'contains':    lambda val: r'%s' % re.escape(val),
-    'icontains':    lambda val: r'%s' % re.escape(val),
+    'iexact':    lambda val: val,
+    'startswith':    lambda val: val,
+    'istartswith':    lambda val: val,
+    'endswith':    lambda val: val,
+    'iendswith':    lambda val: val,
+    'contains':    lambda val: val,
+    'icontains':    lambda val: val,
     'regex':    lambda val: val,
     'iregex':   lambda val: re.compile(val, re.IGNORECASE),
-    'gt':       lambda val: {"_from" : val, "include_lower" : False},
-    'gte':      lambda val: {"_from" : val, "include_lower" : True},
-    'lt':       lambda val: {"_to" : val, "include_upper": False},
-    'lte':      lambda val: {"_to" : val, "include_upper": True},
-    'range':    lambda val: {"_from" : val[0], "_to" : val[1], "include_lower" : True, "include_upper": True},
-    'year':     lambda val: {"_from" : val[0], "_to" : val[1], "include_lower" : True, "include_upper": False},
+    'gt':       lambda val: {"from_value" : val, "include_lower" : False},
+    'gte':      lambda val: {"from_value" : val, "include_lower" : True},
+    'lt':       lambda val: {"to_value" : val, "include_upper": False},
+    'lte':      lambda val: {"to_value" : val, "include_upper": True},
+    'range':    lambda val: {"from_value" : val[0], "to_value" : val[1], "include_lower" : True, "include_upper": True},
+    'year':     lambda val: {"from_value" : val[0], "to_value" : val[1], "include_lower" : True, "include_upper": False},
     'isnull':   lambda val: None if val else {'$ne': None},
     'in':       lambda val: val,
 }
 
-NEGATED_OPERATORS_MAP = {
-    'exact':    lambda val: {'$ne': val},
-    'gt':       lambda val: {"_to" : val, "include_upper": True},
-    'gte':      lambda val: {"_to" : val, "include_upper": False},
-    'lt':       lambda val: {"_from" : val, "include_lower" : True},
-    'lte':      lambda val: {"_from" : val, "include_lower" : False},
-    'isnull':   lambda val: {'$ne': None} if val else None,
-    'in':       lambda val: {'$nin': val},
+# Metric aggregations computing the Django aggregates
+AGGREGATIONS = {
+    'COUNT':    'value_count',
+    'SUM':      'sum',
+    'AVG':      'avg',
+    'MIN':      'min',
+    'MAX':      'max',
 }
 
+# Characters with a meaning in wildcard patterns
+WILDCARD_ESCAPE = re.compile(r'([\\*?])')
+
+# Copies the updated columns into each document matched by an update-by-query
+UPDATE_SCRIPT = "for (entry in params.doc.entrySet()) { ctx._source[entry.getKey()] = entry.getValue() }"
+
+class BoolFilterQuery(Query):
+    """
+    A bool query with all its clauses in filter context: the ORM lookups
+    only select documents, so they are not scored and the nodes can cache
+    their results.
+    """
+    def __init__(self, filters=None):
+        super(BoolFilterQuery, self).__init__()
+        self.filters = []
+        if filters:
+            self.add(filters)
+
+    def add(self, filters):
+        if isinstance(filters, list):
+            self.filters.extend(filters)
+        else:
+            self.filters.append(filters)
+        return self
+
+    def is_empty(self):
+        return not self.filters
+
+    def serialize(self):
+        return {"bool": {"filter": [f.serialize() for f in self.filters]}}
+
+    def __repr__(self):
+        return '<BoolFilterQuery: %r>' % self.serialize()
+
+class SourceSearch(Search):
+    """
+    A search returning only some fields of the _source of the hits: the
+    payload and its decoding scale with the loaded columns. search_after
+    holds the sort values of the last hit of the previous page.
+    """
+    def __init__(self, query=None, source=None, search_after=None, **kwargs):
+        super(SourceSearch, self).__init__(query, **kwargs)
+        self.source = source
+        self.search_after = search_after
+
+    def serialize(self):
+        res = super(SourceSearch, self).serialize()
+        if self.source is not None:
+            res["_source"] = self.source
+        if self.search_after is not None:
+            res["search_after"] = self.search_after
+        return res
+
+# Compiled filter templates by (model, where tree shape)
+_query_cache = {}
+QUERY_CACHE_SIZE = 1000
+
+class Param(object):
+    """
+    Placeholder of a lookup value in a compiled filter template.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def __repr__(self):
+        return '<Param: %d>' % self.index
+
+class FilterTemplate(object):
+    """
+    A serialized filter clause with Param placeholders, compiled once into
+    a function building the clause for a list of values: the parts without
+    placeholders are shared between the built clauses, only the dicts and
+    lists holding values are copied.
+    """
+    def __init__(self, clause):
+        self.clause = clause
+        self._fill = self._compile(clause)
+
+    def _compile(self, value):
+        """
+        @returns: a function(params) building value, None if value has no
+        placeholders
+        """
+        if isinstance(value, Param):
+            index = value.index
+            return lambda params: params[index]
+        if isinstance(value, dict):
+            fillers = [(key, self._compile(item)) for key, item in value.iteritems()]
+            fillers = [(key, filler) for key, filler in fillers if filler is not None]
+            if not fillers:
+                return None
+            variable = set(key for key, filler in fillers)
+            constant = dict((key, item) for key, item in value.iteritems()
+                            if key not in variable)
+            def fill_dict(params):
+                clause = constant.copy()
+                for key, filler in fillers:
+                    clause[key] = filler(params)
+                return clause
+            return fill_dict
+        if isinstance(value, list):
+            fillers = [self._compile(item) for item in value]
+            if not any(fillers):
+                return None
+            fillers = [filler or (lambda params, item=item: item)
+                       for filler, item in zip(fillers, value)]
+            return lambda params: [filler(params) for filler in fillers]
+        return None
+
+    def fill(self, params):
+        """
+        @returns: the clause with the Param placeholders replaced by their
+        values in params
+        """
+        if self._fill is None:
+            return self.clause
+        return self._fill(params)
+
+class ParamFilter(Filter):
+    """
+    A filter clause compiled from a cached template.
+    """
+    def __init__(self, template, params):
+        super(ParamFilter, self).__init__()
+        self.template = template
+        self.params = params
+
+    def serialize(self):
+        return self.template.fill(self.params)
+
 def _get_mapping(db_type, value, mapping):
     # TODO - comments. lotsa comments
 
@@ -96,6 +244,20 @@ def python2db(db_type, value):
 def db2python(db_type, value):
     return _get_mapping(db_type, value, TYPE_MAPPING_FROM_DB)
 
+def millis2python(db_type, value):
+    """
+    Aggregations return the values of date fields as milliseconds since
+    the epoch (the dates are stored as UTC).
+    """
+    if value is None or db_type not in ('datetime', 'date', 'time'):
+        return value
+    value = datetime.utcfromtimestamp(value / 1000.0)
+    if db_type == 'date':
+        return value.date()
+    if db_type == 'time':
+        return value.time()
+    return value
+
 def safe_call(func):
     @wraps(func)
     def _func(*args, **kwargs):
@@ -107,6 +269,36 @@ def safe_call(func):
             raise DatabaseError, DatabaseError(str(e)), sys.exc_info()[2]
     return _func
 
+def send_bulk(connection, actions, batch_size=None):
+    """
+    Sends (header, document) pairs to the _bulk endpoint, in batches of at
+    most batch_size (BULK_SIZE) actions and BULK_MAX_BYTES bytes.
+    document is None for actions without a body (i.e. delete).
+    @returns: the per action results, in the same order as actions
+    """
+    es = connection.db_connection
+    if batch_size is None:
+        batch_size = connection.bulk_size
+    items = []
+    batch, batch_bytes = [], 0
+    for header, document in actions:
+        command = json.dumps(header, cls=es.encoder)
+        if document is not None:
+            command += "\n" + json.dumps(document, cls=es.encoder)
+        if batch and (len(batch) >= batch_size or
+                      batch_bytes + len(command) > connection.bulk_max_bytes):
+            items.extend(_flush_bulk(es, batch))
+            batch, batch_bytes = [], 0
+        batch.append(command)
+        batch_bytes += len(command) + 1
+    if batch:
+        items.extend(_flush_bulk(es, batch))
+    return items
+
+def _flush_bulk(es, batch):
+    result = es._send_request('POST', '/_bulk', "\n".join(batch) + "\n")
+    return [item.values()[0] for item in result['items']]
+
 class DBQuery(NonrelQuery):
     # ----------------------------------------------
     # Public API
@@ -115,7 +307,7 @@ class DBQuery(NonrelQuery):
         super(DBQuery, self).__init__(compiler, fields)
         self._connection = self.connection.db_connection
         self._ordering = []
-        self.db_query = ConstantScoreQuery()
+        self.db_query = BoolFilterQuery()
 
     # This is needed for debugging
     def __repr__(self):
@@ -123,103 +315,529 @@ class DBQuery(NonrelQuery):
 
     @safe_call
     def fetch(self, low_mark, high_mark):
-        results = self._get_results()
+        pks = self.compiler._get_pk_lookup()
+        if pks is not None:
+            # Lookups on the primary key alone are real-time GET/_mget
+            # requests, no search nor refresh needed
+            for entity in self._get_entities(pks)[low_mark:high_mark]:
+                yield entity
+            return
 
-        if low_mark > 0:
-            results = results[low_mark:]
-        if high_mark is not None:
-            results = results[low_mark:high_mark - low_mark]
-
-        for hit in results:
-            entity = hit.get_data()
-            entity['id'] = hit.meta.id
+        for entity in self.iterator(low_mark=low_mark, high_mark=high_mark):
             yield entity
 
+    def iterator(self, chunk_size=None, low_mark=0, high_mark=None):
+        """
+        Streams the entities matching self.query in [low_mark:high_mark],
+        chunk_size hits per request. The first page is a plain from/size
+        search starting at low_mark: a result set fitting in it (i.e.
+        Django's get()) costs a single request. Each next page starts after
+        the sort values of the last hit read (search_after), so every
+        request transfers one page whatever its depth and no context is
+        left open on the server.
+        """
+        if chunk_size is None:
+            chunk_size = self.connection.scroll_size
+        remaining = None if high_mark is None else max(high_mark - low_mark, 0)
+        sort = self._ordering
+        if remaining is None or remaining > chunk_size:
+            # search_after needs a unique sort value, the _uid breaks ties
+            sort = sort + [{"_uid": {"order": "asc"}}]
+        search_after = None
+        while remaining != 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            search = self._get_search(low_mark, size, sort, search_after)
+            results = self._connection.search_raw(search, indices=[self.compiler._get_index()],
+                                                  doc_types=self.query.model._meta.db_table)
+            hits = results['hits']['hits']
+            for hit in hits:
+                yield self._hit_to_entity(hit)
+            if len(hits) < size or remaining == size:
+                return
+            if remaining is not None:
+                remaining -= len(hits)
+            low_mark, search_after = 0, hits[-1]['sort']
+
     @safe_call
     def count(self, limit=None):
-        query = self.db_query
-        if self.db_query.is_empty():
-            query = MatchAllQuery()
-
-        res = self._connection.count(query, doc_types=self.query.model._meta.db_table)
+        path = make_path([self.compiler._get_index(), self.query.model._meta.db_table, '_count'])
+        res = self._connection._send_request('POST', path, {"query": self._get_query().serialize()})
         return res["count"]
 
     @safe_call
     def delete(self):
-        self._collection.remove(self.db_query)
+        """
+        Deletes every document matching self.query with a single
+        server side delete-by-query.
+        @returns: the number of deleted documents
+        """
+        path = make_path([self.compiler._get_index(), self.query.model._meta.db_table,
+                          '_delete_by_query'])
+        body = {"query": self._get_query().serialize()}
+        res = self._connection._send_request('POST', path, body, {'conflicts': 'proceed'})
+        self.connection.bulk_written()
+        return res.get('deleted', 0)
+
+    @safe_call
+    def update(self, values):
+        """
+        Sets values (column -> db value) on every document matching
+        self.query with a single server side update-by-query.
+        @returns: the number of updated documents
+        """
+        path = make_path([self.compiler._get_index(), self.query.model._meta.db_table,
+                          '_update_by_query'])
+        body = {"query": self._get_query().serialize(),
+                "script": {"source": UPDATE_SCRIPT,
+                           "lang": "painless",
+                           "params": {"doc": values}}}
+        res = self._connection._send_request('POST', path, body, {'conflicts': 'proceed'})
+        self.connection.bulk_written()
+        return res.get('updated', 0)
+
+    @safe_call
+    def aggregate(self, aggregates):
+        """
+        Computes aggregates ((alias, sql aggregate) pairs) over the documents
+        matching self.query with a single search of size 0: only the
+        aggregated values travel over the wire.
+        @returns: the values of aggregates, in the same order
+        """
+        response = self._search_aggregations(self._get_metrics(aggregates))
+        total = response['hits']['total']
+        if isinstance(total, dict):
+            total = total['value']
+        bucket = dict(response.get('aggregations') or {}, doc_count=total)
+        return [self._get_metric(bucket, alias, aggregate) for alias, aggregate in aggregates]
+
+    def iter_groups(self, columns, aggregates):
+        """
+        Streams the groups of documents matching self.query by their values
+        of columns (a missing value is a group too), with aggregates
+        computed for each group, as pages of terms aggregations.
+        @returns: iterator of lists of the column values followed by the
+        aggregate values, ordered by column values
+        """
+        for keys, bucket in self._iter_buckets(columns, self._get_metrics(aggregates), True):
+            yield [self._get_key(key, column) for key, column in zip(keys, columns)] + \
+                  [self._get_metric(bucket, alias, aggregate) for alias, aggregate in aggregates]
+
+    def iter_terms(self, column):
+        """
+        Streams the values of column in the documents matching self.query,
+        as pages of terms aggregation buckets.
+        @returns: iterator of (value, number of documents with the value)
+        pairs, ordered by value
+        """
+        for keys, bucket in self._iter_buckets([column]):
+            yield self._get_key(keys[0], column), bucket['doc_count']
+
+    def _iter_buckets(self, columns, aggregations=None, missing=False):
+        """
+        Pages through the groups of documents by their values of columns
+        with nested terms aggregations ordered by term: a request reads the
+        first scroll_size groups after the last one read, so the groups
+        come in order and none is missed, however many values the inner
+        columns have.
+        @returns: iterator of (keys, bucket) pairs ordered by keys, the
+        terms buckets of the groups (None for a missing value, which sorts
+        first, when missing is True) and the innermost bucket
+        """
+        size = self.connection.scroll_size
+        aggregations = self._get_terms_aggregations(columns, aggregations, missing, size)
+        after = None
+        while True:
+            query = self._get_query().serialize()
+            if after is not None:
+                query = {"bool": {"filter": [query, self._get_after_filter(columns, after)]}}
+            response = self._search_aggregations(aggregations, query)
+            groups = list(islice(self._iter_nested_buckets(columns, response['aggregations'],
+                                                           missing, ()), size))
+            for group in groups:
+                yield group
+            if len(groups) < size:
+                return
+            after = groups[-1][0]
+
+    def _get_terms_aggregations(self, columns, aggregations, missing, size):
+        """
+        @returns: the terms aggregations of the first of columns (and a
+        missing one if missing is True) holding the ones of the other
+        columns, aggregations in the innermost
+        """
+        if not columns:
+            return aggregations
+        inner = self._get_terms_aggregations(columns[1:], aggregations, missing, size)
+        field = self._get_column(columns[0])
+        result = {"values": {"terms": {"field": field, "size": size,
+                                       "order": {"_term": "asc"}}}}
+        if missing:
+            result["missing"] = {"missing": {"field": field}}
+        if inner:
+            for aggregation in result.values():
+                aggregation["aggs"] = inner
+        return result
+
+    def _iter_nested_buckets(self, columns, result, missing, keys):
+        if not columns:
+            yield keys, result
+            return
+        groups = result['values']['buckets']
+        if missing and result['missing']['doc_count']:
+            groups = [None] + groups
+        for bucket in groups:
+            inner = result['missing'] if bucket is None else bucket
+            for group in self._iter_nested_buckets(columns[1:], inner, missing, keys + (bucket,)):
+                yield group
+
+    def _get_after_filter(self, columns, keys):
+        """
+        @returns: the filter of the documents in the groups after keys, the
+        terms buckets of columns (None for a missing value)
+        """
+        should, equal = [], []
+        for column, bucket in zip(columns, keys):
+            field = self._get_column(column)
+            if bucket is None:
+                greater = {"exists": {"field": field}}
+                same = {"bool": {"must_not": [greater]}}
+            else:
+                value = bucket.get('key_as_string', bucket['key'])
+                greater = {"range": {field: {"gt": value}}}
+                same = {"term": {field: value}}
+            should.append({"bool": {"filter": equal + [greater]}})
+            equal = equal + [same]
+        return {"bool": {"should": should, "minimum_should_match": 1}}
+
+    def _search_aggregations(self, aggregations, query=None):
+        if query is None:
+            query = self._get_query().serialize()
+        body = {"query": query, "size": 0}
+        if aggregations:
+            body["aggs"] = aggregations
+        path = make_path([self.compiler._get_index(), self.query.model._meta.db_table, '_search'])
+        return self._connection._send_request('GET', path, body)
+
+    def _get_metrics(self, aggregates):
+        """
+        @returns: the metric aggregations of aggregates by alias, the
+        document counts come with every response and need none
+        """
+        metrics = {}
+        for alias, aggregate in aggregates:
+            if self.compiler._is_doc_count(aggregate):
+                continue
+            if not isinstance(aggregate.col, (list, tuple)):
+                raise DatabaseError("Aggregates of aggregates are not supported")
+            metrics[alias] = {AGGREGATIONS[aggregate.sql_function]:
+                              {"field": self._get_column(aggregate.col[1])}}
+        return metrics
+
+    def _get_metric(self, bucket, alias, aggregate):
+        """
+        @returns: the value of aggregate in an aggregation response bucket
+        """
+        if self.compiler._is_doc_count(aggregate):
+            return bucket['doc_count']
+        value = bucket[alias]['value']
+        if value is None or not bucket['doc_count']:
+            # aggregates of no values are NULL, Django turns counts into 0
+            return None
+        if aggregate.sql_function in ('MIN', 'MAX'):
+            return millis2python(aggregate.field.db_type(connection=self.connection), value)
+        return value
+
+    def _get_key(self, bucket, column):
+        """
+        @returns: the value of column in a terms bucket, None for the
+        missing one
+        """
+        if bucket is None:
+            return None
+        value = bucket['key']
+        for field in self.query.get_meta().fields:
+            if field.column == column:
+                return millis2python(field.db_type(connection=self.connection), value)
+        return value
 
     @safe_call
     def order_by(self, ordering):
         for order in ordering:
             if order.startswith('-'):
-                order, direction = order[1:], {"reverse" : True}
+                order, direction = order[1:], "desc"
             else:
-                direction = 'desc'
-            self._ordering.append({order: direction})
+                direction = "asc"
+            self._ordering.append({order: {"order": direction}})
 
-    # This function is used by the default add_filters() implementation
     @safe_call
-    def add_filter(self, column, lookup_type, negated, db_type, value):
-        if column == self.query.get_meta().pk.column:
-            column = '_id'
-        # Emulated/converted lookups
+    def add_filters(self, filters):
+        """
+        Compiles the where tree into nested bool clauses (AND children in
+        must, OR children in should, negated nodes in must_not), so any
+        combination of Q objects runs in a single request.
 
-        if negated and lookup_type in NEGATED_OPERATORS_MAP:
-            op = NEGATED_OPERATORS_MAP[lookup_type]
-            negated = False
+        The compiled clauses are cached per model and tree shape as templates
+        where only the lookup values change: a query of a known shape only
+        prepares its values.
+        """
+        leaves = []
+        key = (self.query.model, self._get_where_shape(filters, leaves))
+        try:
+            template = _query_cache[key]
+        except KeyError:
+            template = self._compile_template(filters, iter(leaves))
+            if len(_query_cache) >= QUERY_CACHE_SIZE:
+                _query_cache.clear()
+            _query_cache[key] = template
+        params = []
+        for leaf in leaves:
+            self._get_params(leaf[1], leaf[3], params)
+        self.db_query.add([ParamFilter(clause, params) for clause in template])
+
+    def _get_where_shape(self, node, leaves):
+        """
+        @returns: a hashable description of the where tree without its
+        values; the decoded leaves, with their prepared values, are appended
+        to leaves
+        """
+        shape = [node.connector, node.negated]
+        for child in self._get_children(node.children):
+            if isinstance(child, Node):
+                shape.append(self._get_where_shape(child, leaves))
+                continue
+            column, lookup_type, db_type, value = self._decode_child(child)
+            if lookup_type == "isnull":
+                # the value decides the clause, not a parameter
+                lookup_type, value = ("isnull", bool(value)), None
+            else:
+                value = self._prepare_value(lookup_type, db_type, value)
+            leaves.append((column, lookup_type, db_type, value))
+            shape.append((column, lookup_type, db_type))
+        return tuple(shape)
+
+    def _get_params(self, lookup_type, value, params):
+        """
+        Appends the values of a leaf that vary between queries to params,
+        in the order of its placeholders (see _parametrize).
+        """
+        if isinstance(lookup_type, tuple):
+            return
+        if isinstance(value, dict):
+            for key in ("from_value", "to_value"):
+                if key in value:
+                    params.append(value[key])
+        else:
+            params.append(value)
+
+    def _parametrize(self, lookup_type, value, params):
+        """
+        @returns: value with Param placeholders instead of the scalars that
+        vary between queries, counting from len(params); the replaced values
+        are appended to params
+        """
+        values = []
+        self._get_params(lookup_type, value, values)
+        if isinstance(value, dict):
+            value = dict(value)
+            for key in ("from_value", "to_value"):
+                if key in value:
+                    value[key] = Param(len(params))
+                    params.append(values.pop(0))
+            return value
+        params.extend(values)
+        return Param(len(params) - 1)
+
+    def _compile_template(self, filters, leaves):
+        """
+        @returns: the serialized top level filter clauses of the where tree,
+        with the placeholders of leaves as values
+        """
+        params = []
+        if filters.connector == AND and not filters.negated:
+            # the top level conditions go straight in the filter clause
+            clauses = self._compile_children(filters, leaves, params)
         else:
-            op = OPERATORS_MAP[lookup_type]
-        value = op(self.convert_value_for_db(db_type, value))
+            queryf = self._compile_where(filters, leaves, params)
+            clauses = queryf is not None and [queryf] or []
+        return [FilterTemplate(clause.serialize()) for clause in clauses]
 
-        queryf = self._get_query_type(column, lookup_type, db_type, value)
+    def _compile_where(self, node, leaves, params):
+        """
+        @returns: the filter clause of a where node, None if it has no
+        conditions
+        """
+        clauses = self._compile_children(node, leaves, params)
+        if not clauses:
+            return None
 
-        if negated:
-            self.db_query.add([NotFilter(queryf)])
+        if len(clauses) == 1:
+            queryf = clauses[0]
+        elif node.connector == OR:
+            queryf = BoolFilter(should=clauses)
         else:
-            self.db_query.add([queryf])
+            queryf = BoolFilter(must=clauses)
+        if node.negated:
+            return BoolFilter(must_not=[queryf])
+        return queryf
+
+    def _compile_children(self, node, leaves, params):
+        clauses = []
+        for child in self._get_children(node.children):
+            if isinstance(child, Node):
+                queryf = self._compile_where(child, leaves, params)
+                if queryf is not None:
+                    clauses.append(queryf)
+                continue
+            column, lookup_type, db_type, value = leaves.next()
+            if isinstance(lookup_type, tuple):
+                clauses.append(self._get_null_filter(column, lookup_type[1]))
+            else:
+                clauses.append(self._get_query_type(self._get_column(column), lookup_type,
+                                                    db_type, self._parametrize(lookup_type, value, params)))
+        return clauses
+
+    def _get_null_filter(self, column, isnull):
+        # null values are not indexed: isnull is a missing field, negations
+        # are a must_not around the whole clause (see _compile_where)
+        queryf = ExistsFilter(self._get_column(column))
+        if isnull:
+            return BoolFilter(must_not=[queryf])
+        return queryf
+
+    def _get_column(self, column):
+        if column == self.query.get_meta().pk.column:
+            return '_id'
+        return column
+
+    def _prepare_value(self, lookup_type, db_type, value):
+        """
+        @returns: the value of a lookup as sent to elasticsearch
+        """
+        value = OPERATORS_MAP[lookup_type](self.convert_value_for_db(db_type, value))
+        if db_type == "unicode":
+            if lookup_type in ("iexact", "istartswith", "iendswith"):
+                value = value.lower()
+            if (lookup_type == "endswith" or lookup_type == "iendswith"):
+                value = "*" + WILDCARD_ESCAPE.sub(r'\\\1', value)
+        return value
 
     def _get_query_type(self, column, lookup_type, db_type, value):
+        """
+        @returns: the filter clause of a lookup for a prepared value, which
+        is used as is (it can be a Param placeholder)
+        """
         if db_type == "unicode":
-            if (lookup_type == "exact" or lookup_type == "iexact"):
-                q = TermQuery(column, value)
-                return q
+            if lookup_type == "exact":
+                return TermFilter(column, value)
+            # The string lookups use the subfields of the field mapping: a
+            # keyword lowercased (lc) for the case insensitive ones, the
+            # analyzed text (tk) for contains
+            if lookup_type in ("iexact", "istartswith", "iendswith"):
+                column = self._get_subfield(column, "lc")
+            if (lookup_type == "iexact"):
+                return TermFilter(column, value)
             if (lookup_type == "startswith" or lookup_type == "istartswith"):
-                return RegexTermFilter(column, value)
+                return PrefixFilter(column, value)
             if (lookup_type == "endswith" or lookup_type == "iendswith"):
-                return RegexTermFilter(column, value)
+                return RawFilter({"wildcard": {column: value}})
             if (lookup_type == "contains" or lookup_type == "icontains"):
-                return RegexTermFilter(column, value)
+                return RawFilter({"match_phrase": {self._get_subfield(column, "tk"): value}})
             if (lookup_type == "regex" or lookup_type == "iregex"):
                 return RegexTermFilter(column, value)
 
-        if db_type == "datetime" or db_type == "date":
-            if (lookup_type == "exact" or lookup_type == "iexact"):
-                return TermFilter(column, value)
+        if (lookup_type == "exact" or lookup_type == "iexact"):
+            return TermFilter(column, value)
 
         #TermFilter, TermsFilter
         if lookup_type in ["gt", "gte", "lt", "lte", "range", "year"]:
-            value['field'] = column
-            return RangeQuery(ESRange(**value))
+            value = dict(value, field=column)
+            return RangeFilter(ESRange(**value))
         if lookup_type == "in":
 #            terms = [TermQuery(column, val) for val in value]
 #            if len(terms) == 1:
 #                return terms[0]
 #            return BoolQuery(should=terms)
             return TermsFilter(field=column, values=value)
-        raise NotImplemented
+        raise DatabaseError("Lookup type %s is not supported" % lookup_type)
 
-    def _get_results(self):
+    def _get_subfield(self, column, name):
         """
-        @returns: elasticsearch iterator over results
-        defined by self.query
+        @returns: the path of the name subfield of column, column itself
+        when its mapping has no such subfield
         """
-        query = self.db_query
+        from .mapping import get_subfield
+        for field in self.query.get_meta().fields:
+            if field.column == column:
+                return get_subfield(field, name)
+        return column
+
+    def _get_query(self):
         if self.db_query.is_empty():
-            query = MatchAllQuery()
+            return MatchAllQuery()
+        return self.db_query
+
+    def _get_search(self, low_mark=0, size=None, sort=None, search_after=None):
+        """
+        @returns: pyes Search for self.query, ordered by sort (the query
+        ordering by default) and restricted to size hits starting from
+        low_mark, or following the search_after sort values
+        """
+        if sort is None:
+            sort = self._ordering
+        return SourceSearch(self._get_query(), source=self._get_source(),
+                            search_after=search_after, start=low_mark or None,
+                            size=size, sort=sort or None)
+
+    def _get_source(self):
+        """
+        @returns: the _source filtering of the hits for self.fields (only(),
+        defer(), values()...): the list of their columns, False for the
+        primary key alone, None when all the fields are loaded
+        """
+        meta = self.query.get_meta()
+        if self.fields is None or len(self.fields) >= len(meta.fields):
+            return None
+        # the primary key is the _id of the hits
+        return [field.column for field in self.fields
+                if field.column != meta.pk.column] or False
+
+    def _get_entities(self, pks):
+        """
+        @returns: the entities stored with the primary keys pks, in the same
+        order (or in the query ordering if any), skipping the missing ones
+        """
+        index, db_table = self.compiler._get_index(), self.query.model._meta.db_table
+        seen = set()
+        pks = [pk for pk in pks if not (pk in seen or seen.add(pk))]
+        if not pks:
+            return []
+        source = self._get_source()
+        if len(pks) == 1:
+            params = {}
+            if source is not None:
+                params['_source'] = source and ','.join(source) or 'false'
+            try:
+                hits = [self._connection._send_request('GET', make_path([index, db_table, pks[0]]),
+                                                       params=params)]
+            except NotFoundException:
+                hits = []
+        else:
+            docs = [{"_index": index, "_type": db_table, "_id": pk} for pk in pks]
+            if source is not None:
+                for doc in docs:
+                    doc["_source"] = source
+            hits = self._connection._send_request('GET', '/_mget', {"docs": docs})['docs']
+
+        entities = [self._hit_to_entity(hit) for hit in hits
+                    if hit.get('exists', hit.get('found', True))]
         if self._ordering:
-            query.sort = self._ordering
-        #print "query", self.query.tables, query
-        return self._connection.search(query, indices=[self.connection.db_name], doc_types=self.query.model._meta.db_table)
+            entities.sort(self._order_in_memory)
+        return entities
+
+    def _hit_to_entity(self, hit):
+        entity = hit.get('_source', {})
+        entity['id'] = hit['_id']
+        return entity
 
 class SQLCompiler(NonrelCompiler):
     """
@@ -227,6 +845,73 @@ class SQLCompiler(NonrelCompiler):
     """
     query_class = DBQuery
 
+    def _get_index(self):
+        """
+        @returns: the index (or alias) holding the documents of the model
+        """
+        return self.connection.index_for_model(self.query.model)
+
+    def results_iter(self):
+        if self.query.aggregate_select:
+            return self._iter_groups()
+        return super(SQLCompiler, self).results_iter()
+
+    def execute_sql(self, result_type=MULTI):
+        """
+        Computes the aggregates of aggregate() in elasticsearch; a single
+        count (i.e. count()) uses the count API.
+        """
+        aggregates = self.query.aggregate_select.items()
+        if not aggregates or len(aggregates) == 1 and self._is_doc_count(aggregates[0][1]):
+            return super(SQLCompiler, self).execute_sql(result_type)
+        self.check_query()
+        row = self.build_query().aggregate(aggregates)
+        if result_type is SINGLE:
+            return row
+        return [row]
+
+    def _iter_groups(self):
+        """
+        values(...).annotate(...): one row per group of the selected
+        columns, with the annotations computed by elasticsearch.
+        """
+        self.check_query()
+        fields = self.get_fields()
+        columns = [field.column for field in fields]
+        group_by = [isinstance(col, (list, tuple)) and col[1] or col
+                    for col in self.query.group_by or ()]
+        if group_by != columns or self.query.get_meta().pk.column in columns:
+            raise DatabaseError("Annotations are only supported on values() querysets")
+        aggregates = self.query.aggregate_select.items()
+        rows = self.build_query(fields).iter_groups(columns, aggregates)
+
+        # the groups come ordered by their values, any other ordering is
+        # done in memory
+        positions = {}
+        for i, field in enumerate(fields):
+            positions[field.name] = positions[field.column] = i
+        for i, (alias, aggregate) in enumerate(aggregates):
+            positions[alias] = len(fields) + i
+        ordering = [order for order in self._get_ordering() if order.lstrip('-') in positions]
+        if ordering:
+            rows = list(rows)
+            for order in reversed(ordering):
+                position = positions[order.lstrip('-')]
+                rows.sort(key=lambda row: row[position], reverse=order.startswith('-'))
+
+        db_types = [field.db_type(connection=self.connection) for field in fields]
+        for row in islice(rows, self.query.low_mark, self.query.high_mark):
+            yield [self.convert_value_from_db(db_type, value)
+                   for db_type, value in zip(db_types, row)] + row[len(fields):]
+
+    def _is_doc_count(self, aggregate):
+        """
+        @returns: True if aggregate counts the documents (COUNT(*) or of the
+        primary key)
+        """
+        return aggregate.sql_function == 'COUNT' and \
+            (aggregate.col == '*' or tuple(aggregate.col)[1:] == (self.query.get_meta().pk.column,))
+
     def convert_value_from_db(self, db_type, value):
         # Handle list types
         if db_type is not None and \
@@ -295,8 +980,65 @@ class SQLCompiler(NonrelCompiler):
                     result.append('-' + name)
         return result
 
+    def _get_pk_lookup(self):
+        """
+        @returns: the primary keys when the where is a single pk exact/in
+        lookup (as built by delete_batch and Model.save), None otherwise
+        """
+        where = self.query.where
+        if where.negated or len(where.children) != 1 or \
+                isinstance(where.children[0], Node):
+            return None
+        constraint, lookup_type, annotation, value = where.children[0]
+        if constraint.field is None or not constraint.field.primary_key:
+            return None
+        if lookup_type == 'in':
+            return list(value)
+        if lookup_type == 'exact':
+            return [value]
+        return None
+
 
 class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
+    def execute_sql(self, return_id=False):
+        return self.insert(self.get_insert_data(), return_id=return_id)
+
+    def get_insert_data(self):
+        """
+        @returns: the column -> db value dict of the row held by self.query
+        """
+        data = {}
+        for (field, value), column in zip(self.query.values, self.query.columns):
+            if field is not None:
+                if not field.null and value is None:
+                    raise IntegrityError("You can't set %s (a non-nullable "
+                                        "field) to None!" % field.name)
+                db_type = field.db_type(connection=self.connection)
+                value = self.convert_value_for_db(db_type, value)
+            data[column] = value
+        return data
+
+    @safe_call
+    def insert_bulk(self, rows, batch_size=None):
+        """
+        Indexes rows (column -> db value dicts) with batched _bulk requests;
+        the refresh policy is applied once at the end.
+        @returns: a (id, error) pair for every row, error is None on success
+        """
+        pk_column = self.query.get_meta().pk.column
+        db_table = self.query.get_meta().db_table
+        index = self._get_index()
+        actions = []
+        for data in rows:
+            header = {"_index": index, "_type": db_table}
+            if data.get(pk_column) is not None:
+                header["_id"] = data[pk_column]
+            actions.append(({"index": header}, data))
+        logging.debug("Bulk insert %s: %d rows" % (db_table, len(actions)))
+        items = send_bulk(self.connection, actions, batch_size)
+        self.connection.bulk_written()
+        return [(item.get('_id'), item.get('error')) for item in items]
+
     @safe_call
     def insert(self, data, return_id=False):
         pk_column = self.query.get_meta().pk.column
@@ -306,36 +1048,80 @@ class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
         db_table = self.query.get_meta().db_table
         logging.debug("Insert data %s: %s" % (db_table, data))
         #print("Insert data %s: %s" % (db_table, data))
-        res = self.connection.db_connection.index(data, self.connection.db_name, db_table, id=pk)
+        res = self.connection.db_connection.index(data, self._get_index(), db_table, id=pk,
+                                                  querystring_args=self.connection.write_params())
         #print "Insert result", res
         return res['_id']
 
-# TODO: Define a common nonrel API for updates and add it to the nonrel
-# backend base classes and port this code to that API
 class SQLUpdateCompiler(SQLCompiler):
-    def execute_sql(self, return_id=False):
+    def execute_sql(self, result_type=MULTI):
+        """
+        Sends only the updated columns: a partial _update per primary key
+        for pk lookups (i.e. Model.save), a server side update-by-query for
+        any other filter. Unchanged fields of the documents are kept.
+        @returns: the number of updated documents
+        """
+        values = self.get_update_data()
+        if not values:
+            return 0
+        pks = self._get_pk_lookup()
+        if pks is None:
+            return self.build_query([self.query.get_meta().pk]).update(values)
+        return self._update_pks(pks, values)
+
+    def get_update_data(self):
         """
-        self.query - the data that should be inserted
+        @returns: the column -> db value dict of the updated fields
         """
         data = {}
-        for (field, value), column in zip(self.query.values, self.query.columns):
-            data[column] = python2db(field.db_type(connection=self.connection), value)
-        # every object should have a unique pk
-        pk_field = self.query.model._meta.pk
-        pk_name = pk_field.attname
+        for field, model, value in self.query.values:
+            if hasattr(value, 'prepare_database_save'):
+                value = value.prepare_database_save(field)
+            else:
+                value = field.get_db_prep_save(value, connection=self.connection)
+            if hasattr(value, 'evaluate'):
+                raise DatabaseError("F() expressions are not supported in updates")
+            data[field.column] = self.convert_value_for_db(field.db_type(connection=self.connection), value)
+        return data
 
+    @safe_call
+    def _update_pks(self, pks, values):
         db_table = self.query.get_meta().db_table
-        res = self.connection.db_connection.index(data, self.connection.db_name, db_table, id=pk)
+        if len(pks) == 1:
+            path = make_path([self._get_index(), db_table, pks[0], '_update'])
+            try:
+                self.connection.db_connection._send_request('POST', path, {"doc": values},
+                                                            self.connection.write_params())
+            except ElasticSearchException, e:
+                if e.status == 404:
+                    return 0
+                raise
+            return 1
 
-        return res['_id']
+        actions = [({"update": {"_index": self._get_index(),
+                                "_type": db_table,
+                                "_id": pk}}, {"doc": values})
+                   for pk in pks]
+        items = send_bulk(self.connection, actions)
+        self.connection.bulk_written()
+        return len([item for item in items if not item.get('error')])
 
 class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
     def execute_sql(self, return_id=False):
         """
-        self.query - the data that should be inserted
+        Deletes a set of primary keys with one _bulk request, and any
+        other filter with a server side delete-by-query.
         """
+        pks = self._get_pk_lookup()
+        if pks is None:
+            return super(SQLDeleteCompiler, self).execute_sql(return_id)
+        if not pks:
+            return
+
         db_table = self.query.get_meta().db_table
-        if len(self.query.where.children) == 1 and isinstance(self.query.where.children[0][0].field, AutoField) and  self.query.where.children[0][1] == "in":
-            for pk in self.query.where.children[0][3]:
-                self.connection.db_connection.delete(self.connection.db_name, db_table, pk)
-        return
+        actions = [({"delete": {"_index": self._get_index(),
+                                "_type": db_table,
+                                "_id": pk}}, None)
+                   for pk in pks]
+        send_bulk(self.connection, actions)
+        self.connection.bulk_written()
@@ -0,0 +1,160 @@
+import errno
+import httplib
+import logging
+import socket
+import sys
+import threading
+import time
+from urllib import urlencode
+
+from pyes.exceptions import NoServerAvailable
+from pyes.fakettypes import Method, RestResponse
+
+logger = logging.getLogger(__name__)
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+
+#methods a node can safely run twice, retried on another node even when
+#the request may have been received
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+def _is_stale(error):
+    """
+    True if error is how a keep-alive connection closed by the server fails
+    on its next use.
+    """
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    if isinstance(error, socket.error) and error.args:
+        return error.args[0] in (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+    return False
+
+class Node(object):
+    """
+    An Elasticsearch node with its idle keep-alive connections.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.outstanding = 0
+        self.failures = 0
+        self.dead_until = 0
+        self._idle = []
+
+    def __repr__(self):
+        return '<Node: %s:%s>' % (self.host, self.port)
+
+    def is_alive(self, now):
+        return self.dead_until <= now
+
+class NodePool(object):
+    """
+    pyes transport spreading the requests over a list of nodes.
+
+    Connections are kept alive and reused (at most maxsize idle ones per
+    node). Nodes are picked round robin or by least outstanding requests;
+    a node failing at the socket level is skipped for retry_time seconds,
+    doubling on each consecutive failure up to max_retry_time.
+
+    A failed request is retried on another node if it was not sent yet or
+    its method is idempotent; a reused connection the server closed while
+    idle is replaced once, without counting as a failure of the node.
+    """
+    def __init__(self, hosts, strategy=ROUND_ROBIN, timeout=None, maxsize=10,
+                 max_retries=3, retry_time=1, max_retry_time=60):
+        if strategy not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError("Unknown node selection strategy: %s" % strategy)
+        self.nodes = [Node(host, port) for host, port in hosts]
+        self.strategy = strategy
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.max_retries = max_retries
+        self.retry_time = retry_time
+        self.max_retry_time = max_retry_time
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def execute(self, request):
+        """Execute a pyes RestRequest and return a RestResponse"""
+        url = request.uri
+        if request.parameters:
+            url += '?' + urlencode(request.parameters)
+        method = Method._VALUES_TO_NAMES[request.method]
+
+        for attempt in range(self.max_retries + 1):
+            node, conn, reused = self._acquire()
+            while True:
+                sent = False
+                try:
+                    conn.request(method, url, request.body or None, request.headers or {})
+                    sent = True
+                    response = conn.getresponse()
+                    body = response.read()
+                except (socket.error, httplib.HTTPException), e:
+                    conn.close()
+                    if reused and _is_stale(e):
+                        # the server closed the idle connection meanwhile:
+                        # resend once on a new one, the node is fine
+                        reused = False
+                        conn = self._connect(node)
+                        continue
+                    error = sys.exc_info()
+                    break
+                if response.will_close:
+                    conn.close()
+                    conn = None
+                self._release(node, conn)
+                return RestResponse(status=response.status, body=body,
+                                    headers=dict(response.getheaders()))
+            self._release(node, None, failed=True)
+            logger.warning("Request to %r failed (attempt %d)", node, attempt + 1, exc_info=error)
+            if sent and method not in IDEMPOTENT_METHODS:
+                # the node may have applied the request, sending it again
+                # could apply it twice
+                raise error[0], error[1], error[2]
+        raise NoServerAvailable
+
+    def _acquire(self):
+        """
+        @returns: (node, connection, True if it is a reused idle one)
+        """
+        with self._lock:
+            node = self._choose()
+            node.outstanding += 1
+            if node._idle:
+                return node, node._idle.pop(), True
+        return node, self._connect(node), False
+
+    def _connect(self, node):
+        return httplib.HTTPConnection(node.host, node.port, timeout=self.timeout)
+
+    def _release(self, node, conn, failed=False):
+        with self._lock:
+            node.outstanding -= 1
+            if failed:
+                node.failures += 1
+                backoff = min(self.retry_time * 2 ** (node.failures - 1), self.max_retry_time)
+                node.dead_until = time.time() + backoff
+                for idle in node._idle:
+                    idle.close()
+                node._idle = []
+                return
+            node.failures = 0
+            node.dead_until = 0
+            if conn is not None:
+                if len(node._idle) < self.maxsize:
+                    node._idle.append(conn)
+                else:
+                    conn.close()
+
+    def _choose(self):
+        now = time.time()
+        alive = [node for node in self.nodes if node.is_alive(now)]
+        if not alive:
+            # every node is backing off: probe the first one to come back
+            return min(self.nodes, key=lambda node: node.dead_until)
+        if self.strategy == LEAST_OUTSTANDING:
+            return min(alive, key=lambda node: node.outstanding)
+        self._next += 1
+        return alive[self._next % len(alive)]
@@ -1,8 +1,13 @@
+from django.core.exceptions import ImproperlyConfigured
 from djangotoolbox.db.base import NonrelDatabaseCreation
 from pyes.exceptions import NotFoundException
+from pyes.utils import make_path
 TEST_DATABASE_PREFIX = 'test_'
 
 class DatabaseCreation(NonrelDatabaseCreation):
+    #mappings by index and doc type, as last read from or put to the cluster
+    _mappings = None
+
     data_types = {
         'DateTimeField':                'datetime',
         'DateField':                    'date',
@@ -46,11 +51,52 @@ class DatabaseCreation(NonrelDatabaseCreation):
         return []
 
     def sql_create_model(self, model, style, known_models=set()):
-        from mapping import model_to_mapping
-        mappings = model_to_mapping(model)
-        self.connection.db_connection.put_mapping(model._meta.db_table, {mappings.name:mappings.as_dict()})
+        from mapping import get_model_mapping
+        doc_type = model._meta.db_table
+        mapping = get_model_mapping(model)
+        if getattr(model._meta, 'index_template', False):
+            self._put_template(model, mapping)
+        self.connection.ensure_model_index(model)
+        index = self.connection.index_for_model(model)
+        mappings = self._current_mappings(index)
+        current = mappings.get(doc_type) or {}
+        if current.get('_meta', {}).get('django_hash') != mapping['_meta']['django_hash']:
+            self.connection.db_connection.put_mapping(doc_type, {doc_type: mapping}, [index])
+            mappings[doc_type] = mapping
         return [], {}
 
+    def _current_mappings(self, index):
+        """
+        Reads the mappings of an index once, with a single request.
+        """
+        if self._mappings is None:
+            self._mappings = {}
+        if index not in self._mappings:
+            try:
+                result = self.connection.db_connection.get_mapping(indices=[index])
+            except NotFoundException:
+                result = {}
+            # an alias answers with the name of the index it points to
+            mappings = result.get(index) or (result.values() or [{}])[0]
+            self._mappings[index] = dict(mappings.get('mappings', mappings))
+        return self._mappings[index]
+
+    def _put_template(self, model, mapping):
+        """
+        Registers an index template applying the settings and the mapping
+        of model to the indices named after its index: the index itself and
+        the versions es_reindex creates (<database>_<index>*).
+        """
+        index = self.connection.index_for_model(model)
+        if index == self.connection.db_name:
+            raise ImproperlyConfigured("%s: index_template needs an ESMeta index"
+                                       % model._meta.object_name)
+        name = "%s_%s" % (self.connection.db_name, model._meta.db_table)
+        body = {"template": index + "*",
+                "settings": self.connection.index_settings_for_model(model),
+                "mappings": {model._meta.db_table: mapping}}
+        self.connection.db_connection._send_request('PUT', make_path(['_template', name]), body)
+
     def set_autocommit(self):
         "Make sure a connection is in autocommit mode."
         pass
@@ -90,7 +136,8 @@ class DatabaseCreation(NonrelDatabaseCreation):
         except NotFoundException:
             pass
 
-        self.connection.db_connection.create_index(test_database_name)
+        self.connection.ensure_index(test_database_name,
+                                     self.connection.index_settings_for_model())
         self.connection.db_connection.cluster_health(wait_for_status='green')
 
         call_command('syncdb', verbosity=max(verbosity - 1, 0), interactive=False, database=self.connection.alias)
@@ -108,10 +155,18 @@ class DatabaseCreation(NonrelDatabaseCreation):
         self.connection.settings_dict['NAME'] = old_database_name
 
     def _drop_database(self, database_name):
+        for index in (database_name, database_name + '_*'):
+            try:
+                self.connection.db_connection.delete_index(index)
+            except NotFoundException:
+                pass
         try:
-            self.connection.db_connection.delete_index(database_name)
+            self.connection.db_connection._send_request(
+                'DELETE', make_path(['_template', database_name + '_*']))
         except NotFoundException:
             pass
+        self.connection.forget_index(database_name)
+        self._mappings = None
         self.connection.db_connection.cluster_health(wait_for_status='green')
 
     def sql_destroy_model(self, model, references_to_delete, style):
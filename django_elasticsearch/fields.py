@@ -139,7 +139,24 @@ def pre_init_mongodb_signal(sender, args, **kwargs):
         setattr(pk, "get_prep_value", autofield_get_prep_value)
 
 class ESMeta(object):
-    pass
+    """
+    Elasticsearch options of a model, declared as an inner ESMeta class and
+    copied on the model _meta:
+
+        class Log(models.Model):
+            class ESMeta:
+                index = 'logs'              # own index (or alias) <database>_logs
+                number_of_shards = 4
+                number_of_replicas = 0
+                refresh_interval = '30s'
+                index_settings = {}         # any other index setting
+                index_template = True       # template for <database>_logs*
+
+    The index settings apply when syncdb creates the index. The template
+    applies them, with the mapping, to any index created under the name of
+    the model index: the index itself if a write creates it, and the
+    versions es_reindex creates.
+    """
 
 def add_elasticsearch_manager(sender, **kwargs):
     """
@@ -0,0 +1,199 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, DEFAULT_DB_ALIAS
+from django.db.models import get_app, get_model, get_models
+from django.utils.importlib import import_module
+from pyes.exceptions import NotFoundException
+from pyes.utils import make_path
+
+from django_elasticsearch.compiler import send_bulk
+from django_elasticsearch.mapping import clear_mapping_cache, get_model_mapping
+
+class Command(BaseCommand):
+    """
+    Rebuilds indices with the current model mappings without downtime: the
+    documents are copied to a new versioned index, then the index name is
+    atomically moved to it as an alias. Searches and writes keep hitting the
+    old index during the copy; the writes made meanwhile are not copied, so
+    the old index is kept unless --delete-old is given.
+
+    Before an index is deleted (a plain index, replaced by the alias, or the
+    old index with --delete-old) it is made read-only and the command fails,
+    keeping it and the alias, if it was written during the copy. Writes
+    sent during the swap are then refused by the server instead of being
+    lost.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='The elasticsearch database to reindex.'),
+        make_option('--batch-size', action='store', dest='batch_size', type='int',
+            default=None, help='Documents read and written per request.'),
+        make_option('--transform', action='store', dest='transform', default=None,
+            help='Dotted path of a function(hit) returning the new _source of a '
+                 'document, or None to drop it.'),
+        make_option('--delete-old', action='store_true', dest='delete_old', default=False,
+            help='Delete the previous index after the alias swap, if it was not '
+                 'written during the copy.'),
+    )
+    help = 'Rebuilds the indices of the given models (or apps) with their current mapping.'
+    args = '[appname.ModelName | appname] ...'
+
+    def handle(self, *labels, **options):
+        self.connection = connections[options['database']]
+        self.es = self.connection.db_connection
+        self.connection.check_server_version()
+        self.batch_size = options['batch_size'] or self.connection.bulk_size
+        self.transform = options['transform'] and self._import(options['transform'])
+        self.verbosity = int(options.get('verbosity', 1))
+        clear_mapping_cache()
+
+        # an index is rebuilt with the mappings of all the models it holds
+        indices = {}
+        for model in self._get_models((), options['database']):
+            indices.setdefault(self.connection.index_for_model(model), []).append(model)
+        selected = set(self.connection.index_for_model(model)
+                       for model in self._get_models(labels, options['database']))
+        for alias in sorted(selected):
+            self.reindex(alias, indices.get(alias) or [], options['delete_old'])
+        self.connection.creation._mappings = None
+
+    def reindex(self, alias, models, delete_old=False):
+        source = self._get_aliased_index(alias)
+        target = "%s_v%s" % (alias, time.strftime('%Y%m%d%H%M%S'))
+        settings = self.connection.index_settings_for_model(models and models[0] or None)
+        self._log("Reindexing %s (%s) into %s" % (alias, source or "missing", target))
+
+        # no refresh nor replicas while copying, restored before the swap
+        copy_settings = dict(settings, refresh_interval='-1', number_of_replicas=0)
+        self.es._send_request('PUT', make_path([target]), {
+            "settings": copy_settings,
+            "mappings": dict((model._meta.db_table, get_model_mapping(model))
+                             for model in models)})
+        if source:
+            written = self._get_write_count(source)
+            self.copy(source, target)
+        self.es._send_request('PUT', make_path([target, '_settings']), {"index": {
+            "refresh_interval": settings.get('refresh_interval', '1s'),
+            "number_of_replicas": settings.get('number_of_replicas', 1)}})
+        self.es.refresh([target])
+
+        actions = [{"add": {"index": target, "alias": alias}}]
+        if source == alias:
+            # an alias cannot take the name of an existing index: the plain
+            # index is removed in the same atomic call that adds the alias
+            actions.insert(0, {"remove_index": {"index": source}})
+        elif source:
+            actions.insert(0, {"remove": {"index": source, "alias": alias}})
+        deleted = source is not None and (source == alias or delete_old)
+        if deleted:
+            self._set_read_only(source, True)
+        try:
+            if deleted and self._get_write_count(source) != written:
+                raise CommandError("%s was written during the copy, it was kept and %s "
+                                   "was not moved: run the command again" % (source, alias))
+            self.es._send_request('POST', '/_aliases', {"actions": actions})
+        except Exception:
+            if deleted:
+                self._set_read_only(source, False)
+            self.es._send_request('DELETE', make_path([target]))
+            raise
+        if source and source != alias:
+            if delete_old:
+                self.es._send_request('DELETE', make_path([source]))
+            elif self._get_write_count(source) != written:
+                self._log("%s was written during the copy, it is kept with the "
+                          "documents missing from %s" % (source, target))
+        self._log("%s now points to %s" % (alias, target))
+
+    def copy(self, source, target):
+        scroll = self.connection.scroll_timeout
+        results = self.es._send_request('GET', make_path([source, '_search']),
+                                        {"size": self.batch_size, "sort": ["_doc"]},
+                                        {"scroll": scroll})
+        total = results['hits']['total']
+        if isinstance(total, dict):
+            total = total['value']
+        scroll_id = results.get('_scroll_id')
+        copied, errors, started = 0, 0, time.time()
+        try:
+            while results['hits']['hits']:
+                actions = []
+                for hit in results['hits']['hits']:
+                    doc = hit['_source']
+                    if self.transform is not None:
+                        doc = self.transform(hit)
+                        if doc is None:
+                            continue
+                    actions.append(({"index": {"_index": target, "_type": hit['_type'],
+                                               "_id": hit['_id']}}, doc))
+                items = send_bulk(self.connection, actions, self.batch_size)
+                errors += len([item for item in items if item.get('error')])
+                copied += len(results['hits']['hits'])
+                elapsed = time.time() - started
+                self._log("  %d/%d documents, %d errors, %.0f docs/s" %
+                          (copied, total, errors, copied / max(elapsed, 0.001)))
+                results = self.es.search_scroll(scroll_id, scroll)
+                scroll_id = results.get('_scroll_id', scroll_id)
+        finally:
+            if scroll_id:
+                try:
+                    self.es._send_request('DELETE', '/_search/scroll', scroll_id)
+                except Exception:
+                    pass
+        if errors:
+            raise CommandError("%d documents could not be copied to %s, "
+                               "the alias was not moved" % (errors, target))
+
+    def _get_write_count(self, index):
+        """
+        @returns: the number of write operations the primaries of index
+        ran, changing whenever a document is indexed or deleted
+        """
+        result = self.es._send_request('GET', make_path([index, '_stats', 'indexing']))
+        indexing = result['_all']['primaries']['indexing']
+        return indexing['index_total'] + indexing['delete_total']
+
+    def _set_read_only(self, index, read_only):
+        self.es._send_request('PUT', make_path([index, '_settings']),
+                              {"index": {"blocks": {"write": read_only}}})
+
+    def _get_aliased_index(self, alias):
+        """
+        @returns: the index behind alias, alias itself if it is a plain
+        index, None if there is no such index
+        """
+        try:
+            result = self.es._send_request('GET', make_path([alias, '_alias']))
+        except NotFoundException:
+            return None
+        for index in result:
+            return index
+        return None
+
+    def _get_models(self, labels, database):
+        if not labels:
+            return [model for model in get_models()
+                    if router.allow_syncdb(database, model)]
+        models = []
+        for label in labels:
+            if '.' in label:
+                model = get_model(*label.split('.', 1))
+                if model is None:
+                    raise CommandError("Unknown model: %s" % label)
+                models.append(model)
+            else:
+                models.extend(get_models(get_app(label)))
+        return models
+
+    def _import(self, path):
+        module, name = path.rsplit('.', 1)
+        try:
+            return getattr(import_module(module), name)
+        except (ImportError, AttributeError), e:
+            raise CommandError("Cannot import %s: %s" % (path, e))
+
+    def _log(self, message):
+        if self.verbosity >= 1:
+            self.stdout.write(message + "\n")
@@ -1,9 +1,14 @@
-from django.db import connections
+from django.db import connections, router
+from django.db.models import Avg, Sum
+from django.db.models.fields import AutoField
 from django.db.models.manager import Manager as DJManager
+from django.db.models.query_utils import deferred_class_factory
+from django.db.models.sql import InsertQuery
 
 import re
 import copy
-from .utils import dict_keys_to_str
+from itertools import islice
+from .utils import dict_keys_to_str, resolve_lazy_objects
 try:
     from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
 except ImportError:
@@ -157,7 +162,9 @@ class QuerySet(object):
         self._where_clause = None
         self._loaded_fields = []
         self._ordering = []
-        self.transform = TransformDjango()
+        self._lookups = []
+        self._refresh = False
+        self._select_related = False
         
         # If inheritance is allowed, only return instances and instances of
         # subclasses of the class being used
@@ -182,6 +189,10 @@ class QuerySet(object):
         """
         if q_obj:
             self._where_clause = q_obj.as_js(self._document)
+        lookups = dict(query)
+        negated = lookups.pop("not", False)
+        if lookups:
+            self._lookups.append((negated, lookups))
         query = QuerySet._transform_query(_doc_cls=self._document, **query)
         self._query.update(query)
         return self
@@ -206,11 +217,109 @@ class QuerySet(object):
         """
         return self.__call__()
     
-    def distinct(self, *args, **kwargs):
+    def distinct(self, field):
+        """Iterate over the unique values of a field in the selected
+        documents, in ascending order. The values are read from terms
+        aggregations ``SCROLL_SIZE`` at a time, each page starting after the
+        last value read, so memory stays flat whatever the number of unique
+        values. Documents without a value are skipped.
+
+        :param field: the field name, ``pk`` for the primary key
         """
-        Distinct method
+        queryset = self._django_queryset()
+        if self._refresh:
+            connections[queryset.db].refresh_if_dirty()
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        field = QuerySet._lookup_field(self._document, field)
+        db_type = field.db_type(connection=compiler.connection)
+        for value, count in compiler.build_query().iter_terms(field.column):
+            yield compiler.convert_value_from_db(db_type, value)
+
+    def iterator(self, chunk_size=None):
+        """Stream the selected documents as model instances, reading
+        ``chunk_size`` hits per request. The :meth:`skip` offset is sent to
+        the server with the first request, each next page follows the last
+        hit read, so no page costs more than the first one and nothing is
+        left open on the server when the iteration stops early.
+
+        :param chunk_size: hits fetched per request (defaults to the
+            ``SCROLL_SIZE`` database option)
         """
-        return self._cursor.distinct(*args, **kwargs)
+        low_mark = self._skip or 0
+        high_mark = None
+        if self._limit is not None:
+            high_mark = low_mark + self._limit
+        return self._iter_documents(chunk_size, low_mark, high_mark)
+
+    def _iter_documents(self, chunk_size, low_mark, high_mark):
+        """Model instances of the selected documents in
+        ``[low_mark:high_mark]``, see :meth:`iterator`.
+        """
+        queryset = self._django_queryset()
+        connection = connections[queryset.db]
+        if self._refresh:
+            connection.refresh_if_dirty()
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        fields = compiler.get_fields()
+        query = compiler.build_query(fields)
+        entities = query.iterator(chunk_size=chunk_size, low_mark=low_mark,
+                                  high_mark=high_mark)
+        if len(fields) < len(self._document._meta.fields):
+            # only(): the other fields are deferred
+            attnames = [field.attname for field in fields]
+            skip = set(field.attname for field in self._document._meta.fields) - set(attnames)
+            document = deferred_class_factory(self._document, skip)
+            docs = (document(**dict(zip(attnames, compiler._make_result(entity, fields))))
+                    for entity in entities)
+        else:
+            docs = (self._document(*compiler._make_result(entity, fields))
+                    for entity in entities)
+        if not self._select_related:
+            for doc in docs:
+                yield doc
+            return
+
+        page_size = chunk_size or connection.scroll_size
+        while True:
+            page = list(islice(docs, page_size))
+            if not page:
+                break
+            resolve_lazy_objects(page)
+            for doc in page:
+                yield doc
+
+    def select_related(self):
+        """Resolve the model references stored in the documents (decoded
+        as lazy objects) a page at a time: one ``pk__in`` query per
+        referenced model instead of one query per reference on access.
+        """
+        self._select_related = True
+        return self
+
+    def refresh(self):
+        """Refresh the index before running the query if documents were
+        written since the last refresh, to read your own writes when the
+        ``REFRESH`` policy doesn't refresh on every write.
+        """
+        self._refresh = True
+        return self
+
+    def _django_queryset(self):
+        """Django queryset equivalent to the lookups and ordering collected
+        so far, so that requests are compiled by the backend compiler.
+        """
+        queryset = self._document._default_manager.all()
+        for negated, lookups in self._lookups:
+            if negated:
+                queryset = queryset.exclude(**lookups)
+            else:
+                queryset = queryset.filter(**lookups)
+        if self._ordering:
+            queryset = queryset.order_by(*[(direction < 0 and "-" or "") + field
+                                           for field, direction in self._ordering])
+        if self._loaded_fields:
+            queryset = queryset.only(*self._loaded_fields)
+        return queryset
 
     @property
     def _collection(self):
@@ -220,14 +329,20 @@ class QuerySet(object):
         return self._collection_obj
     
     def values(self, *args):
-        return (args and [dict(zip(args,[getattr(doc, key) for key in args])) for doc in self]) or [obj for obj in self._cursor.clone()]
+        """Dictionaries of the values of the fields ``args`` (all the fields
+        by default) of the selected documents; only these fields are read
+        from the ``_source`` of the hits.
+        """
+        return list(self._django_queryset().values(*args))
         
     def values_list(self, *args, **kwargs):
         flat = kwargs.pop("flat", False)
         if flat and len(args) != 1:
             raise Exception("args len must be 1 when flat=True")
         
-        return (flat and self.distinct(args[0] if not args[0] in ["id", "pk"] else "_id")) or zip(*[self.distinct(field if not field in ["id", "pk"] else "_id") for field in args])
+        if flat:
+            return self.distinct(args[0])
+        return list(self._django_queryset().values_list(*args))
 
     @property
     def _cursor(self):
@@ -335,15 +450,18 @@ class QuerySet(object):
         :class:`~mongoengine.queryset.DoesNotExist` or `DocumentName.DoesNotExist`
         if no results are found.
 
+        At most two hits are read, with a single search.
+
         .. versionadded:: 0.3
         """
         self.__call__(*q_objs, **query)
-        count = self.count()
-        if count == 1:
-            return self[0]
-        elif count > 1:
-            message = u'%d items returned, instead of 1' % count
-            raise self._document.MultipleObjectsReturned(message)
+        # A single request reading at most two hits is enough to tell
+        # the three cases apart
+        results = list(self._django_queryset()[:2])
+        if len(results) == 1:
+            return results[0]
+        elif results:
+            raise self._document.MultipleObjectsReturned(u'2 or more items returned, instead of 1')
         else:
             raise self._document.DoesNotExist("%s matching query does not exist."
                                               % self._document._meta.object_name)
@@ -365,18 +483,51 @@ class QuerySet(object):
             del query['defaults']
 
         self.__call__(*q_objs, **query)
-        count = self.count()
-        if count == 0:
+        results = list(self._django_queryset()[:2])
+        if not results:
             query.update(defaults)
             doc = self._document(**query)
             doc.save()
             return doc, True
-        elif count == 1:
-            return self.first(), False
+        elif len(results) == 1:
+            return results[0], False
         else:
-            message = u'%d items returned, instead of 1' % count
+            message = u'2 or more items returned, instead of 1'
             raise self._document.MultipleObjectsReturned(message)
 
+    def bulk_create(self, objs, batch_size=None):
+        """Index many documents with batched ``_bulk`` requests, applying
+        the refresh policy once at the end instead of once per document. Primary keys
+        assigned by the server are set on the saved objects; no save signals
+        are sent.
+
+        :param objs: the model instances to index
+        :param batch_size: documents per request (defaults to the
+            ``BULK_SIZE`` database option)
+        :rtype: list of ``(pk, error)`` pairs in the order of ``objs``,
+            ``error`` is None for the documents that were indexed
+        """
+        db = router.db_for_write(self._document)
+        connection = connections[db]
+        rows = []
+        compiler = None
+        for obj in objs:
+            values = [(field, field.get_db_prep_save(field.pre_save(obj, True), connection=connection))
+                      for field in obj._meta.local_fields
+                      if not (isinstance(field, AutoField) and obj.pk is None)]
+            query = InsertQuery(self._document)
+            query.insert_values(values)
+            compiler = query.get_compiler(using=db)
+            rows.append(compiler.get_insert_data())
+        if compiler is None:
+            return []
+
+        results = compiler.insert_bulk(rows, batch_size=batch_size)
+        for obj, (pk, error) in zip(objs, results):
+            if error is None:
+                obj.pk = pk
+        return results
+
     def first(self):
         """Retrieve the first object matching the query.
         """
@@ -409,11 +560,10 @@ class QuerySet(object):
         .. versionadded:: 0.3
         """
         doc_map = {}
+        # without other filters this is a single real-time _mget
+        for doc in self._django_queryset().filter(pk__in=list(object_ids)):
+            doc_map[str(doc.pk)] = doc
 
-        docs = self._collection.find({'_id': {'$in': [ (not isinstance(id, ObjectId) and ObjectId(id)) or id for id in object_ids]}})
-        for doc in docs:
-            doc_map[str(doc['id'])] = self._document(**dict_keys_to_str(doc))
- 
         return doc_map
     
     def count(self):
@@ -509,10 +659,6 @@ class QuerySet(object):
 
         :param n: the maximum number of objects to return
         """
-        if n == 0:
-            self._cursor.limit(1)
-        else:
-            self._cursor.limit(n)
         self._limit = n
 
         # Return self to allow chaining
@@ -524,7 +670,6 @@ class QuerySet(object):
 
         :param n: the number of objects to skip before returning results
         """
-        self._cursor.skip(n)
         self._skip = n
         return self
 
@@ -533,30 +678,33 @@ class QuerySet(object):
         """
         # Slice provided
         if isinstance(key, slice):
-            try:
-                self._cursor_obj = self._cursor[key]
-                self._skip, self._limit = key.start, key.stop
-            except IndexError, err:
-                # PyMongo raises an error if key.start == key.stop, catch it,
-                # bin it, kill it. 
-                start = key.start or 0
-                if start >= 0 and key.stop >= 0 and key.step is None:
-                    if start == key.stop:
-                        self.limit(0)
-                        self._skip, self._limit = key.start, key.stop - start
-                        return self
-                raise err
+            start, stop = key.start or 0, key.stop
+            if start < 0 or (stop is not None and stop < 0) or key.step is not None:
+                raise IndexError("Only slices with positive bounds are supported")
+            if self._limit is not None:
+                stop = self._limit if stop is None else min(stop, self._limit)
+            self._skip = (self._skip or 0) + start
+            if stop is not None:
+                self._limit = max(stop - start, 0)
             # Allow further QuerySet modifications to be performed
             return self
         # Integer index provided
         elif isinstance(key, int):
-            return self._document(**dict_keys_to_str(self._cursor[key]))
+            if key < 0 or (self._limit is not None and key >= self._limit):
+                raise IndexError("QuerySet index out of range")
+            low_mark = (self._skip or 0) + key
+            for doc in self._iter_documents(None, low_mark, low_mark + 1):
+                return doc
+            raise IndexError("QuerySet index out of range")
 
     def only(self, *fields):
         """Load only a subset of this document's fields. ::
         
             post = BlogPost.objects(...).only("title")
         
+        Only these fields are read from the ``_source`` of the hits, the
+        others are loaded on access like Django's deferred fields.
+
         :param fields: fields to include
 
         .. versionadded:: 0.3
@@ -567,12 +715,8 @@ class QuerySet(object):
                 raise InvalidQueryError('Subfields cannot be used as '
                                         'arguments to QuerySet.only')
             # Translate field name
-            field = QuerySet._lookup_field(self._document, field)[-1].db_field
-            self._loaded_fields.append(field)
-
-        # _cls is needed for polymorphism
-        if self._document._meta.get('allow_inheritance'):
-            self._loaded_fields += ['_cls']
+            field = QuerySet._lookup_field(self._document, field)
+            self._loaded_fields.append(field.name)
         return self
 
     def order_by(self, *args):
@@ -587,8 +731,7 @@ class QuerySet(object):
         self._ordering = []
         for col in args:
             self._ordering.append(( (col.startswith("-") and col[1:]) or col, (col.startswith("-") and -1) or 1 ))
-            
-        self._cursor.sort(self._ordering)
+
         return self
 
     def explain(self, format=False):
@@ -605,11 +748,15 @@ class QuerySet(object):
         return plan
 
     def delete(self, safe=False):
-        """Delete the documents matched by the query.
+        """Delete the documents matched by the query with a single
+        server side delete-by-query. Unlike Django's ``QuerySet.delete``
+        the documents are not loaded first, so no delete signals are sent.
 
-        :param safe: check if the operation succeeded before returning
+        :param safe: kept for compatibility, deletes are always acknowledged
         """
-        self._collection.remove(self._query, safe=safe)
+        queryset = self._django_queryset()
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        compiler.build_query([self._document._meta.pk]).delete()
 
     @classmethod
     def _transform_update(cls, _doc_cls=None, **update):
@@ -703,11 +850,7 @@ class QuerySet(object):
             raise OperationError(u'Update failed [%s]' % unicode(e))
 
     def __iter__(self, *args, **kwargs):
-        for obj in self._cursor:
-            data = dict_keys_to_str(obj)
-            if '_id' in data:
-                data['id']=data.pop('_id')
-            yield self._document(**data)
+        return self.iterator()
 
     def _sub_js_fields(self, code):
         """When fields are specified with [~fieldname] syntax, where 
@@ -767,80 +910,59 @@ class QuerySet(object):
         return collection.database.eval(code, *fields)
 
     def sum(self, field):
-        """Sum over the values of the specified field.
+        """Sum over the values of the specified field, computed by a sum
+        aggregation.
 
-        :param field: the field to sum over; use dot-notation to refer to
-            embedded document fields
+        :param field: the field to sum over
         """
-        sum_func = """
-            function(sumField) {
-                var total = 0.0;
-                db[collection].find(query).forEach(function(doc) {
-                    total += (doc[sumField] || 0.0);
-                });
-                return total;
-            }
-        """
-        return self.exec_js(sum_func, field)
+        return self._aggregate(Sum(field)) or 0
 
     def average(self, field):
-        """Average over the values of the specified field.
-
-        :param field: the field to average over; use dot-notation to refer to
-            embedded document fields
-        """
-        average_func = """
-            function(averageField) {
-                var total = 0.0;
-                var num = 0;
-                db[collection].find(query).forEach(function(doc) {
-                    if (doc[averageField]) {
-                        total += doc[averageField];
-                        num += 1;
-                    }
-                });
-                return total / num;
-            }
-        """
-        return self.exec_js(average_func, field)
+        """Average over the values of the specified field, computed by an
+        avg aggregation. The documents without a value are not counted.
+
+        :param field: the field to average over
+        """
+        return self._aggregate(Avg(field))
 
     def item_frequencies(self, list_field, normalize=False):
         """Returns a dictionary of all items present in a list field across
         the whole queried set of documents, and their corresponding frequency.
         This is useful for generating tag clouds, or searching documents.
 
+        The frequencies are the document counts of a terms aggregation, read
+        in pages: an item present twice in a document is counted once.
+
         :param list_field: the list field to use
         :param normalize: normalize the results so they add to 1.0
         """
-        freq_func = """
-            function(listField) {
-                if (options.normalize) {
-                    var total = 0.0;
-                    db[collection].find(query).forEach(function(doc) {
-                        total += doc[listField].length;
-                    });
-                }
-
-                var frequencies = {};
-                var inc = 1.0;
-                if (options.normalize) {
-                    inc /= total;
-                }
-                db[collection].find(query).forEach(function(doc) {
-                    doc[listField].forEach(function(item) {
-                        frequencies[item] = inc + (frequencies[item] || 0);
-                    });
-                });
-                return frequencies;
-            }
-        """
-        return self.exec_js(freq_func, list_field, normalize=normalize)
+        queryset = self._django_queryset()
+        if self._refresh:
+            connections[queryset.db].refresh_if_dirty()
+        compiler = queryset.query.get_compiler(using=queryset.db)
+        column = QuerySet._lookup_field(self._document, list_field).column
+        frequencies = dict(compiler.build_query().iter_terms(column))
+        if normalize:
+            total = float(sum(frequencies.values()))
+            for item in frequencies:
+                frequencies[item] /= total
+        return frequencies
+
+    def _aggregate(self, aggregate):
+        """Value of a Django aggregate over the selected documents,
+        computed with a single aggregation request.
+        """
+        queryset = self._django_queryset()
+        if self._refresh:
+            connections[queryset.db].refresh_if_dirty()
+        return queryset.aggregate(value=aggregate)['value']
 
     def __repr__(self):
         limit = REPR_OUTPUT_SIZE + 1
         if self._limit is not None and self._limit < limit:
             limit = self._limit
-        data = list(self[self._skip:limit])
+        skip = self._skip or 0
+        data = list(self._iter_documents(None, skip, skip + limit))
         if len(data) > REPR_OUTPUT_SIZE:
             data[-1] = "...(remaining elements truncated)..."
         return repr(data)
@@ -878,7 +1000,7 @@ class Manager(DJManager):
             return self
 
         if self._collection is None:
-            self._collection = connections[self.db].db_connection[owner._meta.db_table]
+            self._collection = connections[self.db].db_connection
 
         # owner is the document that contains the QuerySetManager
         queryset = QuerySet(owner, self._collection)
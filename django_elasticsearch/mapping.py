@@ -3,9 +3,38 @@
 
 from pyes import mappings
 from django.conf import settings
+import copy
+import hashlib
+import json
 import time
+from django.db import models
 from django.db.models.manager import Manager
 
+#computed mapping dicts by model class
+_mapping_cache = {}
+
+def get_model_mapping(model):
+    """
+    Given a model return its mapping as a dict, memoized per model class.
+    The dict carries a hash of itself in _meta, to be compared with the
+    mapping stored in the cluster.
+    """
+    try:
+        return _mapping_cache[model]
+    except KeyError:
+        pass
+    mapping = model_to_mapping(model).as_dict()
+    mapping['_meta'] = {'django_hash': mapping_hash(mapping)}
+    _mapping_cache[model] = mapping
+    return mapping
+
+def mapping_hash(mapping):
+    return hashlib.sha1(json.dumps(mapping, sort_keys=True)).hexdigest()
+
+def clear_mapping_cache(**kwargs):
+    _mapping_cache.clear()
+    _related_cache.clear()
+
 def model_to_mapping(model, depth=1):
     """
     Given a model return a mapping
@@ -40,99 +69,151 @@ def model_to_mapping(model, depth=1):
 
     return mapper
 
+#mapping builders by field class (or class name, for optional apps)
+_field_mappings = {}
+#builder resolved for each concrete field class
+_resolved_mappings = {}
+#nested object mappings of related models by (model, depth)
+_related_cache = {}
+#subfield paths by (field class, column, subfield)
+_subfield_cache = {}
+
+#analyzer indexing a whole string lowercased, for case insensitive lookups
+LOWERCASE_KEYWORD = "lowercase_keyword"
+ANALYSIS_SETTINGS = {"analyzer": {LOWERCASE_KEYWORD: {"type": "custom",
+                                                      "tokenizer": "keyword",
+                                                      "filter": ["lowercase"]}}}
+
+def register_field_mapping(*field_classes):
+    """
+    Registers a mapping builder for some field classes and their subclasses.
+    A class can be given by name when its app may not be installed.
+
+        @register_field_mapping(MyGeoField)
+        def geo_mapping(field, depth=1, **options):
+            return mappings.GeoPointField(name=field.name, store=True)
+
+    The builder returns a pyes mapping or None to leave the field out.
+    """
+    def register(builder):
+        for field_class in field_classes:
+            _field_mappings[field_class] = builder
+        _resolved_mappings.clear()
+        _subfield_cache.clear()
+        return builder
+    return register
+
+def get_subfield(field, name):
+    """
+    The path of the name subfield of field ('title.tk'), or the field
+    itself when its mapping has no such subfield
+    """
+    key = (type(field), field.column, name)
+    try:
+        return _subfield_cache[key]
+    except KeyError:
+        pass
+    path = field.column
+    mapper = get_mapping_for_field(field, depth=-1)
+    if isinstance(mapper, mappings.MultiField) and name in mapper.fields:
+        path = "%s.%s" % (field.column, name)
+    _subfield_cache[key] = path
+    return path
+
 def get_mapping_for_field(field, depth=1, **options):
     """Given a field returns a mapping"""
-    ntype = type(field).__name__
-    if ntype in ["AutoField"]:
-#        return mappings.MultiField(name=field.name,
-#                                   fields={field.name:mappings.StringField(name=field.name, store=True),
-#                                           "int":mappings.IntegerField(name="int", store=True)}
-#                                   )
-        return mappings.StringField(name=field.name, store=True)
-    elif ntype in ["IntegerField",
-                   "PositiveSmallIntegerField",
-                   "SmallIntegerField",
-                   "PositiveIntegerField",
-                   "PositionField",
-                   ]:
-        return mappings.IntegerField(name=field.name, store=True)
-    elif ntype in ["FloatField",
-                   "DecimalField",
-                   ]:
-        return mappings.DoubleField(name=field.name, store=True)
-    elif ntype in ["BooleanField",
-                   "NullBooleanField",
-                   ]:
-        return mappings.BooleanField(name=field.name, store=True)
-    elif ntype in ["DateField",
-                   "DateTimeField",
-                   "CreationDateTimeField",
-                   "ModificationDateTimeField",
-                   "AddedDateTimeField",
-                   "ModifiedDateTimeField",
-                   "brainaetic.djangoutils.db.fields.CreationDateTimeField",
-                   "brainaetic.djangoutils.db.fields.ModificationDateTimeField",
-                   ]:
-        return mappings.DateField(name=field.name, store=True)
-    elif ntype in ["SlugField",
-                   "EmailField",
-                   "TagField",
-                   "URLField",
-                   "CharField",
-                   "ImageField",
-                   "FileField",
-                   ]:
-        return mappings.MultiField(name=field.name,
-                                   fields={field.name:mappings.StringField(name=field.name, index="not_analyzed", store=True),
-                                           "tk":mappings.StringField(name="tk", store=True,
-                                                                index="analyzed",
-                                                                term_vector="with_positions_offsets")}
-
-                                   )
-    elif ntype in ["TextField",
-                   ]:
-        data = dict(name=field.name, store=True,
-                       index="analyzed",
-                       term_vector="with_positions_offsets"
-                       )
-        if field.unique:
-            data['index'] = 'not_analyzed'
-
-        data.update(options)
-
-        if  data['index'] == 'not_analyzed':
-            del data['term_vector']
-
-        return mappings.StringField(**data)
-    elif ntype in ["ForeignKey",
-                   "TaggableManager",
-                   "GenericRelation",
-                   ]:
-        if depth >= 0:
-            mapper = model_to_mapping(field.rel.to, depth - 1)
-            if mapper:
-                mapper.name = field.name
-                return mapper
-            return None
-        return get_mapping_for_field(field.rel.to._meta.pk, depth - 1)
-
-#                   "IPAddressField",
-#                   'PickledObjectField'
-
-    elif ntype in ["ManyToManyField",
-                   ]:
-        if depth > 0:
-            mapper = model_to_mapping(field.rel.to, depth - 1)
+    ftype = type(field)
+    try:
+        builder = _resolved_mappings[ftype]
+    except KeyError:
+        builder = None
+        for klass in ftype.__mro__:
+            builder = _field_mappings.get(klass) or _field_mappings.get(klass.__name__)
+            if builder is not None:
+                break
+        _resolved_mappings[ftype] = builder
+    if builder is None:
+        return None
+    return builder(field, depth=depth, **options)
+
+def related_mapping(model, depth, name):
+    """
+    The object mapping of a related model, built once per (model, depth)
+    """
+    key = (model, depth)
+    try:
+        mapper = _related_cache[key]
+    except KeyError:
+        mapper = _related_cache[key] = model_to_mapping(model, depth)
+    mapper = copy.copy(mapper)
+    mapper.name = name
+    return mapper
+
+@register_field_mapping(models.AutoField)
+def auto_field_mapping(field, depth=1, **options):
+    return mappings.StringField(name=field.name, store=True)
+
+@register_field_mapping(models.IntegerField, "PositionField")
+def integer_mapping(field, depth=1, **options):
+    return mappings.IntegerField(name=field.name, store=True)
+
+@register_field_mapping(models.BigIntegerField)
+def long_mapping(field, depth=1, **options):
+    return mappings.LongField(name=field.name, store=True)
+
+@register_field_mapping(models.FloatField, models.DecimalField)
+def double_mapping(field, depth=1, **options):
+    return mappings.DoubleField(name=field.name, store=True)
+
+@register_field_mapping(models.BooleanField, models.NullBooleanField)
+def boolean_mapping(field, depth=1, **options):
+    return mappings.BooleanField(name=field.name, store=True)
+
+@register_field_mapping(models.DateField)
+def date_mapping(field, depth=1, **options):
+    return mappings.DateField(name=field.name, store=True)
+
+@register_field_mapping(models.CharField, models.FileField, "TagField")
+def keyword_mapping(field, depth=1, **options):
+    return mappings.MultiField(name=field.name,
+                               fields={field.name:mappings.StringField(name=field.name, index="not_analyzed", store=True),
+                                       "tk":mappings.StringField(name="tk", store=True,
+                                                            index="analyzed",
+                                                            term_vector="with_positions_offsets"),
+                                       "lc":mappings.StringField(name="lc", index="analyzed",
+                                                            analyzer=LOWERCASE_KEYWORD)}
+
+                               )
+
+@register_field_mapping(models.TextField)
+def text_mapping(field, depth=1, **options):
+    data = dict(name=field.name, store=True,
+                   index="analyzed",
+                   term_vector="with_positions_offsets"
+                   )
+    if field.unique:
+        data['index'] = 'not_analyzed'
+
+    data.update(options)
+
+    if  data['index'] == 'not_analyzed':
+        del data['term_vector']
+
+    return mappings.StringField(**data)
+
+@register_field_mapping(models.ForeignKey, "TaggableManager", "GenericRelation")
+def foreign_key_mapping(field, depth=1, **options):
+    if depth >= 0:
+        return related_mapping(field.rel.to, depth - 1, field.name)
+    return get_mapping_for_field(field.rel.to._meta.pk, depth - 1)
+
+@register_field_mapping(models.ManyToManyField)
+def many_to_many_mapping(field, depth=1, **options):
+    if depth > 0:
+        return related_mapping(field.rel.to, depth - 1, field.name)
+    if depth == 0:
+        mapper = get_mapping_for_field(field.rel.to._meta.pk, depth - 1)
+        if mapper:
             mapper.name = field.name
             return mapper
-        if depth == 0:
-            mapper = get_mapping_for_field(field.rel.to._meta.pk, depth - 1)
-            if mapper:
-                mapper.name = field.name
-                return mapper
-            return None
-        if depth < 0:
-            return None
-    print ntype
     return None
-
@@ -1,4 +1,8 @@
 from django.db.models import signals
 from .fields import add_elasticsearch_manager
+from .mapping import clear_mapping_cache
+from .serializer import clear_model_cache
 
-signals.class_prepared.connect(add_elasticsearch_manager)
\ No newline at end of file
+signals.class_prepared.connect(add_elasticsearch_manager)
+signals.class_prepared.connect(clear_model_cache)
+signals.class_prepared.connect(clear_mapping_cache)
@@ -1,63 +1,195 @@
 from django.utils.importlib import import_module
-from datetime import datetime, date, time
-#TODO Add content type cache
+from datetime import datetime, date, time, timedelta
 from utils import ModelLazyObject
 from json import JSONDecoder, JSONEncoder
+import json
 import uuid
 
+#optional C JSON libraries, tried in this order
+JSON_BACKENDS = ('ujson',)
+
+#module of the JSON library in use, None for the json module
+_backend = None
+
+def set_json_backend(name=None):
+    """
+    Selects the JSON library decoding the responses: one of JSON_BACKENDS,
+    'json' for the json module, None for the first one installed.
+    @returns: the name of the library in use
+    """
+    global _backend
+    _backend = None
+    for backend in name is None and JSON_BACKENDS or (name,):
+        if backend == 'json':
+            break
+        try:
+            _backend = import_module(backend)
+            break
+        except ImportError:
+            if name is not None:
+                raise
+    return _backend and _backend.__name__ or 'json'
+
+set_json_backend()
+
+def _loads(data):
+    if _backend is None:
+        return json.loads(data)
+    return _backend.loads(data, precise_float=True)
+
+def format_datetime(value):
+    """
+    ISO 8601 representation of a datetime, or of a date at midnight,
+    as stored in the documents.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value.isoformat() + "T00:00:00"
+
+def parse_datetime(value):
+    """
+    Parses a datetime stored by format_datetime (or by the server). A UTC
+    offset is applied, the result is in UTC as the naive datetimes are
+    stored. Strings of another format are returned as is.
+    """
+    if not isinstance(value, basestring) or len(value) < 10:
+        return value
+    try:
+        if len(value) == 10:
+            return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+        end, microsecond = 19, 0
+        if value[19:20] == '.':
+            end = 20
+            while value[end:end + 1].isdigit():
+                end += 1
+            microsecond = int(value[20:end][:6].ljust(6, '0'))
+        result = datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                          int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                          microsecond)
+    except ValueError:
+        return value
+    offset = value[end:]
+    if not offset or offset == 'Z':
+        return result
+    digits = offset[1:].replace(':', '')
+    if offset[0] not in '+-' or len(digits) not in (2, 4) or not digits.isdigit():
+        return value
+    minutes = int(digits[:2]) * 60 + int(digits[2:] or 0)
+    if offset[0] == '+':
+        return result - timedelta(minutes=minutes)
+    return result + timedelta(minutes=minutes)
+
+#(_app, _model) of a stored reference -> model class
+_model_cache = {}
+#model class -> (_app, _model) to store in its references
+_reference_cache = {}
+
+def clear_model_cache(**kwargs):
+    """
+    Drops the resolved references, i.e. when new models get registered.
+    """
+    _model_cache.clear()
+    _reference_cache.clear()
+
+def get_model_class(app, name):
+    """
+    Resolves the _app/_model pair of a stored reference to its model class.
+    The pair is an app label and model name for installed models, or a
+    module path and class name for models outside the app cache. The
+    result is cached for the life of the process and no query is made.
+    """
+    key = (app, name)
+    model = _model_cache.get(key)
+    if model is None:
+        from django.db.models import get_model
+        model = get_model(app, name)
+        if model is None:
+            model = getattr(import_module(app), name)
+        _model_cache[key] = model
+    return model
+
+def get_reference(model):
+    """
+    Returns the (_app, _model) pair under which references to instances
+    of model are stored.
+    """
+    cls = model.__class__
+    reference = _reference_cache.get(cls)
+    if reference is None:
+        from django.db.models import get_model
+        meta = cls._meta
+        if get_model(meta.app_label, meta.module_name) is cls:
+            reference = (meta.app_label, meta.module_name)
+        else:
+            reference = (cls.__module__, meta.object_name)
+        _reference_cache[cls] = reference
+    return reference
+
 class Decoder(JSONDecoder):
-    """Extends the base simplejson JSONDecoder for Dejavu."""
+    """Extends the base simplejson JSONDecoder for Dejavu.
+
+    The references and embedded models are decoded in a single pass, only
+    the dicts with a _type are touched; responses holding none are parsed
+    without any hook, by the C JSON library in use if any.
+    """
     def __init__(self, arena=None, encoding=None, object_hook=None, **kwargs):
-        JSONDecoder.__init__(self, encoding, object_hook, **kwargs)
-        if not self.object_hook:
-            self.object_hook = self.json_to_python
+        # the hook must be known at init time, when the scanner is built
+        JSONDecoder.__init__(self, encoding, object_hook or self.decode_object, **kwargs)
         self.arena = arena
+        self._plain = object_hook is None and not kwargs
+
+    def decode(self, s, *args, **kwargs):
+        if not self._plain:
+            return JSONDecoder.decode(self, s, *args, **kwargs)
+        if '"django"' not in s and '"emb"' not in s:
+            # nothing to hook
+            return _loads(s)
+        if _backend is None:
+            return JSONDecoder.decode(self, s, *args, **kwargs)
+        return self.json_to_python(_loads(s))
+
+    def decode_object(self, son):
+        """
+        @returns: the model of a decoded JSON object, itself if it is no
+        reference nor embedded model
+        """
+        if son.get("_type") in (u"django", u"emb") and "_model" in son:
+            return self.decode_django(son)
+        return son
 
     def json_to_python(self, son):
-        
+        """
+        Decodes the references and embedded models in an already parsed
+        JSON value, innermost first.
+        """
         if isinstance(son, dict):
-            if "_type" in son and son["_type"] in [u"django", u'emb']:
-                son = self.decode_django(son)
-            else:
-                for (key, value) in son.items():
-                    if isinstance(value, dict):
-                        if "_type" in value and value["_type"] in [u"django", u'emb']:
-                            son[key] = self.decode_django(value)
-                        else:
-                            son[key] = self.json_to_python(value)
-                    elif hasattr(value, "__iter__"): # Make sure we recurse into sub-docs
-                        son[key] = [self.json_to_python(item) for item in value]
-                    else: # Again, make sure to recurse into sub-docs
-                        son[key] = self.json_to_python(value)
-        elif hasattr(son, "__iter__"): # Make sure we recurse into sub-docs
-            son = [self.json_to_python(item) for item in son]
+            for key, value in son.iteritems():
+                if isinstance(value, (dict, list)):
+                    son[key] = self.json_to_python(value)
+            return self.decode_object(son)
+        if isinstance(son, list):
+            return [isinstance(item, (dict, list)) and self.json_to_python(item) or item
+                    for item in son]
         return son
 
     def decode_django(self, data):
-        from django.contrib.contenttypes.models import ContentType
+        model = get_model_class(data['_app'], data['_model'])
         if data['_type']=="django":
-            model = ContentType.objects.get(app_label=data['_app'], model=data['_model'])
-            return ModelLazyObject(model.model_class(), data['pk'])
+            return ModelLazyObject(model, data['pk'])
         elif data['_type']=="emb":
-            try:
-                model = ContentType.objects.get(app_label=data['_app'], model=data['_model']).model_class()
-            except:
-                module = import_module(data['_app'])
-                model = getattr(module, data['_model'])            
-            
             del data['_type']
             del data['_app']
             del data['_model']
             data.pop('_id', None)
+            # the values are decoded already
             values = {}
             for k,v in data.items():
-                values[str(k)] = self.json_to_python(v)
+                values[str(k)] = v
             return model(**values)
 
 class Encoder(JSONEncoder):
     def __init__(self, *args, **kwargs):
         JSONEncoder.__init__(self, *args, **kwargs)
-        
 
     def encode_django(self, model):
         """
@@ -67,19 +199,13 @@ class Encoder(JSONEncoder):
         if isinstance(model, EmbeddedModel):
             if model.pk is None:
                 model.pk = str(uuid.uuid4())
-            res = {'_app':model._meta.app_label, 
-                   '_model':model._meta.module_name,
+            app, name = get_reference(model)
+            res = {'_app':app,
+                   '_model':name,
                    '_id':model.pk}
             for field in model._meta.fields:
                 res[field.attname] = self.default(getattr(model, field.attname))
             res["_type"] = "emb"
-            from django.contrib.contenttypes.models import ContentType
-            try:
-                ContentType.objects.get(app_label=res['_app'], model=res['_model'])
-            except:
-                res['_app'] = model.__class__.__module__
-                res['_model'] = model._meta.object_name
-                
             return res
         if not model.pk:
             model.save()
@@ -98,11 +224,8 @@ class Encoder(JSONEncoder):
         from django.db.models import Model
         from django_elasticsearch.fields import EmbeddedModel
 
-        if isinstance(value, datetime):
-            return value.strftime("%Y-%m-%dT%H:%M:%S")
-        elif isinstance(value, date):
-            dt = datetime(value.year, value.month, value.day, 0, 0, 0)
-            return dt.strftime("%Y-%m-%dT%H:%M:%S")
+        if isinstance(value, (datetime, date)):
+            return format_datetime(value)
 #        elif isinstance(value, dict):
 #            for (key, value) in value.items():
 #                if isinstance(value, (str, unicode)):
@@ -28,3 +28,40 @@ class ModelLazyObject(SimpleLazyObject):
 
     def _load_data(self):
         return self._model.objects.get(pk=self._pk)
+
+def resolve_lazy_objects(objs):
+    """
+    Loads the unresolved ModelLazyObject references held by objs (model
+    instances, lists and dicts, walked recursively) with one pk__in query
+    per referenced model. References to missing objects are left lazy.
+    """
+    pending = {}
+    _collect_lazy_objects(objs, pending, set())
+    for model, lazy_objects in pending.items():
+        instances = model._default_manager.in_bulk(list(set(lazy._pk for lazy in lazy_objects)))
+        for lazy in lazy_objects:
+            if lazy._pk in instances:
+                lazy._wrapped = instances[lazy._pk]
+
+def _collect_lazy_objects(value, pending, seen):
+    from django.db.models import Model
+    # type() is checked first: isinstance() on an unresolved lazy object
+    # would load it through its __class__ property
+    if type(value) is ModelLazyObject:
+        if value._wrapped is None:
+            pending.setdefault(value._model, []).append(value)
+        return
+    if id(value) in seen:
+        return
+    if isinstance(value, Model):
+        seen.add(id(value))
+        for field in value._meta.fields:
+            _collect_lazy_objects(value.__dict__.get(field.attname), pending, seen)
+    elif isinstance(value, dict):
+        seen.add(id(value))
+        for item in value.values():
+            _collect_lazy_objects(item, pending, seen)
+    elif isinstance(value, (list, tuple)):
+        seen.add(id(value))
+        for item in value:
+            _collect_lazy_objects(item, pending, seen)
@@ -0,0 +1,91 @@
+"""
+Decoding throughput of search responses: pages of hits shaped like the
+documents of the test models, with and without references to other models
+and embedded models. The recursive decoder used before is kept here as the
+baseline. No request is sent.
+
+Run from the tests directory:
+
+    DJANGO_SETTINGS_MODULE=testproj.settings python benchmarks/json_decode.py [pages]
+"""
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+
+from django_elasticsearch import serializer
+
+PAGE_SIZE = 500
+
+class RecursiveDecoder(serializer.Decoder):
+    """
+    The decoder before the single pass one: every object hook walks the
+    whole subtree again. Its isinstance and hasattr checks also loaded
+    every decoded reference, with a request each: dicts and lists are
+    told apart with type() here, so that only the decoding is measured.
+    """
+    def __init__(self, *args, **kwargs):
+        serializer.Decoder.__init__(self, *args, object_hook=self.json_to_python, **kwargs)
+
+    def json_to_python(self, son):
+        if type(son) is dict:
+            if "_type" in son and son["_type"] in [u"django", u'emb']:
+                son = self.decode_django(son)
+            else:
+                for (key, value) in son.items():
+                    if type(value) is dict:
+                        if "_type" in value and value["_type"] in [u"django", u'emb']:
+                            son[key] = self.decode_django(value)
+                        else:
+                            son[key] = self.json_to_python(value)
+                    elif type(value) is list:
+                        son[key] = [self.json_to_python(item) for item in value]
+                    else:
+                        son[key] = self.json_to_python(value)
+        elif type(son) is list:
+            son = [self.json_to_python(item) for item in son]
+        return son
+
+def page(references):
+    started = datetime(2012, 1, 1)
+    hits = []
+    for i in xrange(PAGE_SIZE):
+        source = {"title": u"entry %d" % i,
+                  "content": u"lorem ipsum dolor sit amet " * 20,
+                  "date_published": serializer.format_datetime(started + timedelta(minutes=i)),
+                  "tags": [u"tag%d" % (i % 7), u"tag%d" % (i % 11)]}
+        if references:
+            source["blog"] = {"_app": "myapp", "_model": "blog", "pk": i % 10, "_type": "django"}
+            source["emb"] = {"_app": "myapp", "_model": "emodel", "_id": str(i),
+                             "title": u"e%d" % i, "pos": i, "_type": "emb"}
+        hits.append({"_index": "test", "_type": "myapp_entry", "_id": str(i),
+                     "_score": 1.0, "_source": source})
+    return json.dumps({"took": 3, "timed_out": False,
+                       "hits": {"total": PAGE_SIZE, "max_score": 1.0, "hits": hits}})
+
+def decode(body, decoder, pages):
+    started = time.time()
+    for i in xrange(pages):
+        json.loads(body, cls=decoder)
+    return pages * PAGE_SIZE / (time.time() - started)
+
+def main(pages):
+    backends = ['json'] + [name for name in serializer.JSON_BACKENDS if _installed(name)]
+    for references in (False, True):
+        body = page(references)
+        print "%s references, %d KB pages" % (references and "with" or "without", len(body) / 1024)
+        print "  %-10s %10.0f hits/s" % ("recursive", decode(body, RecursiveDecoder, pages))
+        for name in backends:
+            serializer.set_json_backend(name)
+            print "  %-10s %10.0f hits/s" % (name, decode(body, serializer.Decoder, pages))
+    serializer.set_json_backend()
+
+def _installed(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,48 @@
+"""
+CPU time of the compile stage (build_query and serialization of the
+search body) with and without the compiled query cache. No request is sent.
+
+Run from the tests directory:
+
+    DJANGO_SETTINGS_MODULE=testproj.settings python benchmarks/query_compile.py [iterations]
+"""
+import sys
+import time
+
+from django.conf import settings
+from django.db.models import Q
+
+from django_elasticsearch import compiler
+from testproj.myapp.models import Person
+
+def querysets(i):
+    return [
+        Person.objects.filter(name="name%d" % i),
+        Person.objects.filter(name__istartswith="jo%d" % i, age__gte=i).order_by("-age"),
+        Person.objects.filter(Q(surname__icontains="smith") | Q(age__in=[i, i + 1, i + 2]),
+                              ~Q(name="x%d" % i)),
+    ]
+
+def compile_all(iterations, cached):
+    batch = [queryset for i in xrange(iterations) for queryset in querysets(i)]
+    started = time.clock()
+    for queryset in batch:
+        if not cached:
+            compiler._query_cache.clear()
+        query = queryset.query.get_compiler(queryset.db).build_query()
+        query._get_search(0, 20).serialize()
+    return time.clock() - started
+
+def main(iterations):
+    # as in production: no query log, which serializes every query again
+    settings.DEBUG = False
+    compile_all(10, True)
+    uncached = compile_all(iterations, False)
+    cached = compile_all(iterations, True)
+    count = iterations * len(querysets(0))
+    print "%d queries" % count
+    print "without cache: %8.1f us/query" % (uncached / count * 1e6)
+    print "with cache:    %8.1f us/query" % (cached / count * 1e6)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,78 @@
+"""
+Latency of the string lookups: the regexp queries the compiler used to send
+against the prefix/term/match_phrase queries it sends now.
+
+Run from the tests directory against the configured elasticsearch database:
+
+    DJANGO_SETTINGS_MODULE=testproj.settings python benchmarks/string_lookups.py [documents]
+"""
+import random
+import string
+import sys
+import time
+
+from django.db import connections
+from pyes.utils import make_path
+
+from django_elasticsearch.compiler import send_bulk
+from django_elasticsearch.mapping import get_model_mapping
+from testproj.myapp.models import Person
+
+INDEX = "bench_string_lookups"
+RUNS = 50
+
+# (ORM lookup, regexp query sent before)
+LOOKUPS = [
+    ({"name__startswith": "Jo"}, {"regexp": {"name": "Jo.*"}}),
+    ({"name__istartswith": "jo"}, {"regexp": {"name": "[jJ][oO].*"}}),
+    ({"name__endswith": "son"}, {"regexp": {"name": ".*son"}}),
+    ({"surname__contains": "Smith"}, {"regexp": {"surname": ".*Smith.*"}}),
+]
+
+def random_word(size):
+    return "".join(random.choice(string.ascii_letters) for i in range(size))
+
+def load(connection, count):
+    es = connection.db_connection
+    try:
+        es.delete_index(INDEX)
+    except Exception:
+        pass
+    es._send_request('PUT', make_path([INDEX]), {
+        "settings": connection.index_settings_for_model(Person),
+        "mappings": {Person._meta.db_table: get_model_mapping(Person)}})
+    names = ["John", "Johnson", "Mary", "Jones", "Smith"]
+    actions = [({"index": {"_index": INDEX, "_type": Person._meta.db_table}},
+                {"name": random.choice(names) + random_word(4),
+                 "surname": "%s %s" % (random_word(6), random.choice(names))})
+               for i in range(count)]
+    send_bulk(connection, actions)
+    es.refresh([INDEX])
+
+def timed(es, query):
+    path = make_path([INDEX, Person._meta.db_table, '_search'])
+    timings = []
+    for i in range(RUNS):
+        started = time.time()
+        es._send_request('GET', path, {"query": query, "size": 10})
+        timings.append((time.time() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+def main(count):
+    connection = connections['default']
+    es = connection.db_connection
+    load(connection, count)
+    print "%d documents, median of %d runs" % (count, RUNS)
+    print "%-28s %12s %12s" % ("lookup", "regexp ms", "now ms")
+    try:
+        for lookup, regexp in LOOKUPS:
+            compiled = Person.objects.filter(**lookup).query.get_compiler('default') \
+                             .build_query()._get_query().serialize()
+            before = {"constant_score": {"filter": regexp}}
+            print "%-28s %12.2f %12.2f" % (lookup.keys()[0], timed(es, before), timed(es, compiled))
+    finally:
+        es.delete_index(INDEX)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -29,6 +29,19 @@ class Person(models.Model):
     def __unicode__(self):
         return u"Person: %s %s" % (self.name, self.surname)
 
+class LogEntry(models.Model):
+    message = models.CharField(max_length=200)
+
+    class ESMeta:
+        index = 'logs'
+        number_of_shards = 2
+        number_of_replicas = 0
+        refresh_interval = '30s'
+        index_template = True
+
+    def __unicode__(self):
+        return u"Log: %s" % self.message
+
 class StandardAutoFieldModel(models.Model):
     title = models.CharField(max_length=200)
     
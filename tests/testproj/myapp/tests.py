@@ -1,12 +1,54 @@
 """
 Test suite for django-elasticsearch.
 """
+from __future__ import with_statement
 
+from contextlib import contextmanager
+from django.db import connections
 from django.test import TestCase
-from testproj.myapp.models import Entry, Blog, StandardAutoFieldModel, Person, TestFieldModel, EModel
+from django_elasticsearch import serializer
+from testproj.myapp.models import Entry, Blog, StandardAutoFieldModel, Person, TestFieldModel, EModel, LogEntry
 import datetime
+import json
 import time
 
+class SentRequest(object):
+    def __init__(self, method, path, body, params):
+        self.method, self.path, self.body, self.params = method, path, body, params
+        self.response = None
+
+@contextmanager
+def recording_requests(target=None):
+    """
+    Records the requests sent through target, an ES connection (the default
+    one by default) or the ES class for every connection, as SentRequest
+    objects appended to the yielded list.
+    """
+    if target is None:
+        target = connections['default'].db_connection
+    requests = []
+    send_request = target._send_request
+    original = vars(target).get('_send_request')
+    def record(send, method, path, body=None, params=None, *args, **kwargs):
+        request = SentRequest(method, path, body, params)
+        requests.append(request)
+        request.response = send(method, path, body, params, *args, **kwargs)
+        return request.response
+    if isinstance(target, type):
+        def recording(es, *args, **kwargs):
+            return record(lambda *args, **kwargs: send_request(es, *args, **kwargs),
+                          *args, **kwargs)
+        target._send_request = recording
+    else:
+        target._send_request = lambda *args, **kwargs: record(send_request, *args, **kwargs)
+    try:
+        yield requests
+    finally:
+        if original is None:
+            del target._send_request
+        else:
+            target._send_request = original
+
 class DjangoESTest(TestCase):
 #    multi_db = True
 
@@ -38,6 +80,11 @@ class DjangoESTest(TestCase):
             Blog.objects.get(title="blog1"),
             blog1
         )
+        # the count API takes the query wrapped in a body
+        with recording_requests() as requests:
+            self.assertEqual(Blog.objects.filter(title="blog1").count(), 1)
+        self.assertEqual([(r.method, r.path.rsplit('/', 1)[-1], r.body.keys()) for r in requests],
+                         [('POST', '_count', ['query'])])
 
     def test_simple_filter(self):
         blog1 = Blog(title="same title")
@@ -106,6 +153,500 @@ class DjangoESTest(TestCase):
         self.assertEqual(blog1.title, bl.title)
         bl.delete()
 
+    def test_slice_transfer_is_flat(self):
+        for i in range(40):
+            Blog(title="blog %02d" % i).save()
+        sizes = []
+        for offset in (0, 10, 30):
+            with recording_requests() as requests:
+                page = list(Blog.objects.all()[offset:offset + 5])
+            self.assertEqual(len(page), 5)
+            sizes.append(sum(len(repr(request.response)) for request in requests))
+        # A deeper page must not cost more than a shallow one
+        self.assertTrue(max(sizes) < min(sizes) * 1.5, sizes)
+        # the offset is sent to the server for windows bigger than a page
+        # and for open-ended slices too: only the requested hits travel
+        connection = connections['default']
+        scroll_size, connection.scroll_size = connection.scroll_size, 10
+        try:
+            for window, titles in ((slice(12, 35), ["blog %02d" % i for i in range(12, 35)]),
+                                   (slice(33, None), ["blog %02d" % i for i in range(33, 40)])):
+                with recording_requests() as requests:
+                    page = list(Blog.objects.order_by('title')[window])
+                self.assertEqual([blog.title for blog in page], titles)
+                self.assertEqual(json.loads(requests[0].body)['from'], window.start)
+                self.assertEqual(sum(len(request.response['hits']['hits'])
+                                     for request in requests), len(titles))
+        finally:
+            connection.scroll_size = scroll_size
+        self.assertEqual([blog.title for blog in Blog.objects.order_by('-title')[:3]],
+                         ["blog 39", "blog 38", "blog 37"])
+
+    def test_iterator_streams_in_chunks(self):
+        for i in range(25):
+            Blog(title="blog %02d" % i).save()
+        with recording_requests() as requests:
+            titles = [blog.title for blog in Blog.es.iterator(chunk_size=10)]
+        self.assertEqual(sorted(titles), ["blog %02d" % i for i in range(25)])
+        self.assertEqual(len(requests), 3)
+        self.assertTrue('search_after' in json.loads(requests[-1].body))
+
+        with recording_requests() as requests:
+            stream = Blog.es.iterator(chunk_size=10)
+            stream.next()
+            stream.close()
+        self.assertEqual(len(requests), 1)
+
+        # a result set fitting in one page is a single plain search
+        with recording_requests() as requests:
+            self.assertEqual(len(list(Blog.objects.all())), 25)
+            self.assertEqual(Blog.objects.get(title="blog 03").title, "blog 03")
+        self.assertEqual([(r.method, 'scroll' in r.path) for r in requests],
+                         [('GET', False), ('GET', False)])
+
+        # limits stop the iteration, small windows are a single search
+        with recording_requests() as requests:
+            self.assertEqual([blog.title for blog in Blog.es.order_by('title')[5:8]],
+                             ["blog 05", "blog 06", "blog 07"])
+            self.assertEqual(Blog.es.order_by('title').first().title, "blog 00")
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(len(list(Blog.es.order_by('title').limit(12).iterator(chunk_size=5))), 12)
+
+    def test_bulk_create(self):
+        blogs = [Blog(title="bulk %02d" % i) for i in range(25)]
+        results = Blog.es.bulk_create(blogs, batch_size=10)
+        self.assertEqual(len(results), 25)
+        self.assertEqual([error for pk, error in results], [None] * 25)
+        self.assertEqual([blog.pk for blog in blogs], [pk for pk, error in results])
+        self.assertEqual(Blog.objects.count(), 25)
+        self.assertEqual(Blog.objects.get(pk=blogs[3].pk).title, "bulk 03")
+
+    def test_refresh_policy_override(self):
+        connection = connections['default']
+        with recording_requests() as requests:
+            with connection.refresh_policy_override('never'):
+                Blog(title="unrefreshed").save()
+        self.assertFalse([r for r in requests if 'refresh' in (r.params or {})])
+        self.assertEqual([blog.title for blog in Blog.es.refresh()], ["unrefreshed"])
+        self.assertEqual(connection.refresh_policy, 'always')
+
+    def test_filtered_delete(self):
+        for i in range(5):
+            Blog(title="doomed").save()
+        kept = Blog(title="kept")
+        kept.save()
+        Blog.es.filter(title="doomed").delete()
+        self.assertEqual(Blog.objects.count(), 1)
+
+        others = [Blog(title="other %d" % i) for i in range(3)]
+        for blog in others:
+            blog.save()
+        Blog.objects.filter(pk__in=[blog.pk for blog in others]).delete()
+        self.assertEqual(list(Blog.objects.all()), [kept])
+
+    def test_partial_update(self):
+        p1 = Person(name="igor", surname="duck", age=39)
+        p1.save()
+        p2 = Person(name="andrea", surname="duck", age=29)
+        p2.save()
+        self.assertEqual(Person.objects.filter(pk=p1.pk).update(age=40), 1)
+        self.assertEqual(Person.objects.filter(surname="duck").update(surname="goose"), 2)
+        p1 = Person.objects.get(pk=p1.pk)
+        self.assertEqual((p1.name, p1.surname, p1.age), (u"igor", u"goose", 40))
+        p2 = Person.objects.get(pk=p2.pk)
+        self.assertEqual((p2.name, p2.surname, p2.age), (u"andrea", u"goose", 29))
+
+    def test_get_single_request(self):
+        blog1 = Blog(title="blog1")
+        blog1.save()
+        Blog(title="twin").save()
+        Blog(title="twin").save()
+        with recording_requests() as requests:
+            self.assertEqual(Blog.es.get(title="blog1"), blog1)
+        self.assertEqual(len(requests), 1)
+        with recording_requests() as requests:
+            self.assertEqual(Blog.objects.get(title="blog1"), blog1)
+        self.assertEqual(len(requests), 1)
+        with recording_requests() as requests:
+            self.assertEqual(Blog.es.get(pk=blog1.pk), blog1)
+        self.assertEqual([(r.method, r.path) for r in requests],
+                         [('GET', '/%s/myapp_blog/%s' % (connections['default'].db_name, blog1.pk))])
+        self.assertRaises(Blog.MultipleObjectsReturned, Blog.es.get, title="twin")
+        self.assertRaises(Blog.DoesNotExist, Blog.es.get, title="missing")
+        self.assertRaises(Blog.DoesNotExist, Blog.es.get, pk="missing")
+
+    def test_pk_in_uses_mget(self):
+        connection = connections['default']
+        blogs = [Blog(title="blog %d" % i) for i in range(3)]
+        with connection.refresh_policy_override('never'):
+            for blog in blogs:
+                blog.save()
+        # real-time: visible without any refresh
+        pks = [blogs[2].pk, "missing", blogs[0].pk]
+        self.assertEqual(list(Blog.objects.filter(pk__in=pks)), [blogs[2], blogs[0]])
+        self.assertEqual(Blog.es.in_bulk([blogs[1].pk]), {str(blogs[1].pk): blogs[1]})
+
+    def test_reference_resolution_is_cached(self):
+        blog = Blog(title="referenced")
+        blog.save()
+        data = serializer.Encoder().encode({"blog": blog, "emb": EModel(title="e", pos=3)})
+        decoded = serializer.Decoder().decode(data)
+        self.assertEqual(decoded["blog"].title, "referenced")
+        self.assertEqual(decoded["emb"].test_func(), 3)
+        self.assertTrue(serializer._model_cache[("myapp", "blog")] is Blog)
+        self.assertTrue(EModel in serializer._reference_cache)
+
+    def test_json_codec(self):
+        serializer.set_json_backend('json')
+        try:
+            now = datetime.datetime(2012, 1, 2, 3, 4, 5, 600)
+            data = serializer.Encoder().encode({"when": now, "day": now.date(),
+                                                "items": [{"emb": EModel(title="e", pos=3)}]})
+            decoded = json.loads(data, cls=serializer.Decoder)
+            self.assertEqual(decoded["when"], "2012-01-02T03:04:05.000600")
+            self.assertEqual(decoded["day"], "2012-01-02T00:00:00")
+            self.assertEqual(decoded["items"][0]["emb"].test_func(), 3)
+            self.assertEqual(json.loads('{"hits": [{"_type": "myapp_entry", "a": [1]}]}',
+                                        cls=serializer.Decoder),
+                             {"hits": [{"_type": "myapp_entry", "a": [1]}]})
+            self.assertEqual(serializer.parse_datetime(decoded["when"]), now)
+            self.assertEqual(serializer.parse_datetime("2012-01-02T03:04:05.6Z"),
+                             datetime.datetime(2012, 1, 2, 3, 4, 5, 600000))
+            # offsets are applied, datetimes are stored in UTC
+            self.assertEqual(serializer.parse_datetime("2012-01-02T03:04:05+02:00"),
+                             datetime.datetime(2012, 1, 2, 1, 4, 5))
+            self.assertEqual(serializer.parse_datetime("2012-01-02T03:04:05.5-0130"),
+                             datetime.datetime(2012, 1, 2, 4, 34, 5, 500000))
+            self.assertEqual(serializer.parse_datetime("not a date"), "not a date")
+        finally:
+            serializer.set_json_backend()
+
+    def test_select_related_resolves_references(self):
+        blogs = [Blog(title="ref %d" % i) for i in range(3)]
+        for blog in blogs:
+            blog.save()
+        for i in range(4):
+            TestFieldModel(title="t%d" % i, mlist=blogs).save()
+        for doc in TestFieldModel.es.select_related():
+            self.assertEqual(len(doc.mlist), 3)
+            for ref in doc.mlist:
+                self.assertTrue(ref.__dict__['_wrapped'] is not None)
+            self.assertEqual([ref.title for ref in doc.mlist], ["ref 0", "ref 1", "ref 2"])
+
+    def test_index_checked_once_per_process(self):
+        from pyes import ES
+        from django_elasticsearch.base import DatabaseWrapper
+        settings_dict = dict(connections['default'].settings_dict)
+        settings_dict['OPTIONS'] = {'AUTO_CREATE_INDEX': True}
+        with recording_requests(ES) as requests:
+            for i in range(3):
+                wrapper = DatabaseWrapper(settings_dict, 'index_check')
+                wrapper.db_connection
+        # the test index was created by create_test_db, nothing to probe
+        self.assertEqual(requests, [])
+
+    def test_unchanged_mapping_is_not_put(self):
+        from django_elasticsearch.mapping import get_model_mapping
+        connection = connections['default']
+        creation = connection.creation
+        creation._mappings = None
+        with recording_requests() as requests:
+            creation.sql_create_model(Blog, None)
+            creation.sql_create_model(Person, None)
+        # syncdb already put both mappings: one read, no writes
+        self.assertEqual([r.method for r in requests], ['GET'])
+        self.assertTrue(get_model_mapping(Blog) is get_model_mapping(Blog))
+
+    def test_field_mapping_registry(self):
+        from django.db import models
+        from pyes import mappings
+        from django_elasticsearch import mapping
+
+        class StampField(models.DateTimeField):
+            pass
+        class ColorField(models.CharField):
+            pass
+        self.assertEqual(mapping.get_mapping_for_field(StampField(name="stamp")).type, "date")
+
+        @mapping.register_field_mapping(ColorField)
+        def color_mapping(field, depth=1, **options):
+            return mappings.StringField(name=field.name, index="not_analyzed")
+        self.assertEqual(mapping.get_mapping_for_field(ColorField(name="color")).type, "string")
+
+        mapping.clear_mapping_cache()
+        mapping.model_to_mapping(Entry)
+        blog = mapping._related_cache[(Blog, 0)]
+        self.assertTrue(mapping.related_mapping(Blog, 0, "other").properties is blog.properties)
+
+    def test_model_index_settings(self):
+        connection = connections['default']
+        index = connection.index_for_model(LogEntry)
+        self.assertEqual(index, connection.db_name + "_logs")
+        self.assertEqual(connection.index_for_model(Blog), connection.db_name)
+        LogEntry(message="started").save()
+        self.assertEqual(LogEntry.objects.count(), 1)
+        self.assertEqual(Blog.objects.count(), 0)
+        settings = connection.db_connection._send_request('GET', '/%s/_settings' % index)
+        index_settings = settings.values()[0]['settings']['index']
+        self.assertEqual(str(index_settings['number_of_shards']), "2")
+        self.assertEqual(index_settings['refresh_interval'], "30s")
+        templates = connection.db_connection._send_request(
+            'GET', '/_template/%s_myapp_logentry' % connection.db_name)
+        self.assertEqual(templates.values()[0]['template'], index + "*")
+
+    def test_reindex_swaps_alias(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        for i in range(5):
+            LogEntry(message="log %d" % i).save()
+        connection = connections['default']
+        index = connection.index_for_model(LogEntry)
+        output = StringIO()
+        call_command('es_reindex', 'myapp.LogEntry', batch_size=2, stdout=output)
+        aliased = connection.db_connection._send_request('GET', '/%s/_alias' % index).keys()
+        self.assertEqual(len(aliased), 1)
+        self.assertTrue(aliased[0].startswith(index + "_v"))
+        self.assertTrue("5/5 documents" in output.getvalue())
+        self.assertEqual(LogEntry.objects.count(), 5)
+        self.assertEqual(LogEntry.objects.get(message="log 3").message, "log 3")
+
+    def test_string_lookups_without_regex(self):
+        Person(name="John", surname="Smith Jones").save()
+        Person(name="johanna", surname="Doe").save()
+        Person(name="Mary", surname="Jones").save()
+        self.assertEqual(Person.objects.filter(name__startswith="Jo").count(), 1)
+        self.assertEqual(Person.objects.filter(name__istartswith="jo").count(), 2)
+        self.assertEqual(Person.objects.filter(name__iexact="JOHN").count(), 1)
+        self.assertEqual(Person.objects.filter(name__endswith="anna").count(), 1)
+        self.assertEqual(Person.objects.filter(surname__icontains="jones").count(), 2)
+
+        queryset = Person.objects.filter(name__istartswith="jo", surname__contains="Jones")
+        query = queryset.query.get_compiler('default').build_query()
+        serialized = json.dumps(query._get_query().serialize())
+        self.assertTrue('"prefix": {"name.lc": "jo"}' in serialized)
+        self.assertTrue('"match_phrase": {"surname.tk": "Jones"}' in serialized)
+        self.assertFalse("regex" in serialized)
+
+    def test_lookups_in_filter_context(self):
+        Person(name="Ann", surname="A", age=20).save()
+        Person(name="Bob", surname="B", age=40).save()
+        Person(name="Cid", surname="C").save()
+        queryset = Person.objects.filter(age__gte=18, name="Ann")
+        query = queryset.query.get_compiler('default').build_query()._get_query().serialize()
+        self.assertEqual(query.keys(), ["bool"])
+        self.assertEqual(query["bool"].keys(), ["filter"])
+        self.assertEqual(queryset.count(), 1)
+        # as in SQL, excluding a comparison keeps the rows without a value
+        self.assertEqual(Person.objects.exclude(age__gt=30).count(), 2)
+        self.assertEqual(Person.objects.filter(age__isnull=True).count(), 1)
+        self.assertEqual(Person.objects.exclude(name="Ann").count(), 2)
+
+    def test_or_and_nested_not(self):
+        from django.db.models import Q
+        Person(name="Ann", surname="Smith", age=20).save()
+        Person(name="Bob", surname="Jones", age=40).save()
+        Person(name="Cid", surname="Smith", age=60).save()
+        self.assertEqual(Person.objects.filter(Q(name="Ann") | Q(age__gt=50)).count(), 2)
+        self.assertEqual(Person.objects.filter(Q(surname="Smith"), ~Q(age=20) | Q(name="Bob")).count(), 1)
+        self.assertEqual(Person.objects.exclude(Q(name="Ann") | ~Q(surname="Smith")).count(), 1)
+        query = Person.objects.filter(Q(name="Ann") | Q(name="Bob")) \
+                      .query.get_compiler('default').build_query()._get_query().serialize()
+        self.assertEqual(len(query["bool"]["filter"][0]["bool"]["should"]), 2)
+
+    def test_query_cache_by_shape(self):
+        from django_elasticsearch import compiler
+        Person(name="Ann", surname="Smith", age=20).save()
+        Person(name="Bob", surname="Jones", age=40).save()
+        compiler._query_cache.clear()
+        self.assertEqual(Person.objects.filter(name="Ann", age__gte=10).count(), 1)
+        self.assertEqual(len(compiler._query_cache), 1)
+        # same shape, other values: the template is reused with the new values
+        self.assertEqual(Person.objects.filter(name="Bob", age__gte=50).count(), 0)
+        self.assertEqual(Person.objects.filter(name="Bob", age__gte=30).count(), 1)
+        self.assertEqual(len(compiler._query_cache), 1)
+        self.assertEqual(Person.objects.filter(age__isnull=True).count(), 0)
+        self.assertEqual(Person.objects.filter(age__isnull=False).count(), 2)
+        self.assertEqual(len(compiler._query_cache), 3)
+
+    def test_server_side_aggregations(self):
+        from django.db.models import Avg, Count, Max, Min, Sum
+        Person(name="Ann", surname="Smith", age=20).save()
+        Person(name="Bob", surname="Jones", age=40).save()
+        Person(name="Cid", surname="Smith", age=60).save()
+        Person(name="Dan", surname="Smith").save()
+        self.assertEqual(Person.objects.aggregate(Avg('age'), Sum('age'), Min('age'),
+                                                  Max('age'), Count('id'), Count('age')),
+                         {'age__avg': 40.0, 'age__sum': 120, 'age__min': 20,
+                          'age__max': 60, 'id__count': 4, 'age__count': 3})
+        self.assertEqual(Person.objects.filter(age__gt=100).aggregate(Max('age'), Count('id')),
+                         {'age__max': None, 'id__count': 0})
+        self.assertEqual(list(Person.objects.values('surname').annotate(n=Count('id'), a=Avg('age'))),
+                         [{'surname': 'Jones', 'n': 1, 'a': 40.0},
+                          {'surname': 'Smith', 'n': 3, 'a': 40.0}])
+        self.assertEqual(list(Person.objects.values_list('surname').annotate(n=Count('id'))
+                                            .order_by('-n')[:1]),
+                         [('Smith', 3)])
+        # pages of two groups, the missing values first
+        connection = connections['default']
+        scroll_size, connection.scroll_size = connection.scroll_size, 2
+        try:
+            self.assertEqual(list(Person.objects.values_list('surname', 'age')
+                                                .annotate(n=Count('id'))),
+                             [('Jones', 40, 1), ('Smith', None, 1),
+                              ('Smith', 20, 1), ('Smith', 60, 1)])
+        finally:
+            connection.scroll_size = scroll_size
+
+    def test_queryset_native_aggregations(self):
+        Person(name="Ann", surname="Smith", age=20).save()
+        Person(name="Bob", surname="Jones", age=40).save()
+        Person(name="Cid", surname="Smith").save()
+        self.assertEqual(Person.es.sum("age"), 60)
+        self.assertEqual(Person.es.filter(surname="Jones").average("age"), 40.0)
+        self.assertEqual(Person.es.filter(age__gt=100).sum("age"), 0)
+        TestFieldModel(title="a", mlist=["x", "y"]).save()
+        TestFieldModel(title="b", mlist=["x"]).save()
+        self.assertEqual(TestFieldModel.es.item_frequencies("mlist"),
+                         {"x": 2, "y": 1})
+        frequencies = TestFieldModel.es.item_frequencies("mlist", normalize=True)
+        self.assertAlmostEqual(frequencies["x"], 2 / 3.0)
+        self.assertAlmostEqual(sum(frequencies.values()), 1.0)
+
+    def test_distinct_pages_terms_buckets(self):
+        for i in range(5):
+            Person(name="n%d" % (i % 3), surname="s", age=i).save()
+        Person(name="n9", surname="t").save()
+        connection = connections['default']
+        scroll_size, connection.scroll_size = connection.scroll_size, 2
+        try:
+            self.assertEqual(list(Person.es.distinct("name")),
+                             ["n0", "n1", "n2", "n9"])
+            self.assertEqual(list(Person.es.filter(surname="s")
+                                  .values_list("name", flat=True)),
+                             ["n0", "n1", "n2"])
+            # documents without a value are skipped
+            self.assertEqual(list(Person.es.distinct("age")), [0, 1, 2, 3, 4])
+        finally:
+            connection.scroll_size = scroll_size
+
+    def test_source_filtering(self):
+        now = datetime.datetime(2012, 1, 2, 3, 4, 5)
+        Entry(title="entry 1", content="x" * 1000, date_published=now).save()
+
+        def source(queryset):
+            compiler = queryset.query.get_compiler('default')
+            return compiler.build_query(compiler.get_fields())._get_search().serialize().get("_source")
+        self.assertEqual(source(Entry.objects.only('title', 'date_published')),
+                         ['title', 'date_published'])
+        self.assertEqual(source(Entry.objects.values('id')), False)
+        self.assertEqual(source(Entry.objects.all()), None)
+
+        entry = Entry.objects.only('title', 'date_published').get(title="entry 1")
+        self.assertNotIn('content', entry.__dict__)
+        self.assertEqual(entry.date_published, now)
+        # deferred fields are still loaded on access
+        self.assertEqual(entry.content, "x" * 1000)
+        self.assertEqual(list(Entry.objects.values_list('title', 'date_published')),
+                         [("entry 1", now)])
+        entry = list(Entry.es.only('title'))[0]
+        self.assertEqual(entry.title, "entry 1")
+        self.assertNotIn('content', entry.__dict__)
+
+    def test_node_pool_round_robin_and_backoff(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from pyes.fakettypes import Method, RestRequest
+        from django_elasticsearch.connection import NodePool
+        import threading
+
+        served = []
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def do_GET(self):
+                served.append(self.server.server_port)
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write("{}")
+            def log_message(self, *args):
+                pass
+
+        servers = [HTTPServer(("127.0.0.1", 0), Handler) for i in range(2)]
+        for server in servers:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        ports = [server.server_port for server in servers]
+        # the third node refuses connections
+        dead = HTTPServer(("127.0.0.1", 0), Handler)
+        dead_port = dead.server_port
+        dead.server_close()
+        pool = NodePool([("127.0.0.1", port) for port in ports + [dead_port]])
+        try:
+            request = RestRequest(method=Method.GET, uri="/", parameters={}, headers={}, body="")
+            for i in range(6):
+                self.assertEqual(pool.execute(request).status, 200)
+            self.assertEqual(sorted(set(served)), sorted(ports))
+            self.assertTrue(pool.nodes[2].dead_until > time.time())
+            self.assertEqual(pool.nodes[2].failures, 1)
+            self.assertEqual([len(node._idle) for node in pool.nodes], [1, 1, 0])
+        finally:
+            # the stand-in servers block on open keep-alive connections
+            for node in pool.nodes:
+                for conn in node._idle:
+                    conn.close()
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+
+    def test_node_pool_retries(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from pyes.fakettypes import Method, RestRequest
+        from django_elasticsearch.connection import NodePool
+        import socket
+        import threading
+
+        served = []
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def do_GET(self):
+                served.append(self.command)
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write("{}")
+                # drop the keep-alive connection behind the client back
+                self.close_connection = 1
+            def do_POST(self):
+                served.append(self.command)
+                self.rfile.read(int(self.headers["Content-Length"]))
+                time.sleep(0.5)
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        pool = NodePool([("127.0.0.1", server.server_port)] * 2, timeout=0.2)
+        try:
+            # a stale idle connection is replaced, the node stays alive
+            request = RestRequest(method=Method.GET, uri="/", parameters={}, headers={}, body="")
+            for i in range(4):
+                self.assertEqual(pool.execute(request).status, 200)
+            self.assertEqual(served, ["GET"] * 4)
+            self.assertEqual([node.failures for node in pool.nodes], [0, 0])
+
+            # a POST that may have been applied is not sent again
+            del served[:]
+            request = RestRequest(method=Method.POST, uri="/_bulk", parameters={},
+                                  headers={}, body="{}\n")
+            self.assertRaises(socket.timeout, pool.execute, request)
+            time.sleep(0.5)
+            self.assertEqual(served, ["POST"])
+        finally:
+            server.shutdown()
+            server.server_close()
+
 #    def test_dates_ordering(self):
 #        now = datetime.datetime.now()
 #        before = now - datetime.timedelta(days=1)